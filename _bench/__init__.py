@@ -0,0 +1,6 @@
+"""
+Offline benchmarks for the plugins. See _bench/run.py.
+
+Like _lib, the leading underscore keeps the potnanny plugin loader from
+loading anything in here as a plugin.
+"""
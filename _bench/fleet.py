@@ -0,0 +1,790 @@
+"""
+Simulated BLE device fleet, for load testing the plugins without hardware.
+
+Fleet emulates the protocols the plugins speak, over a fake BleakClient:
+
+  - MiFlora: battery/firmware on 1a02, mode change write on 1a00, and the
+    16 byte measurement block on 1a01
+  - MJ-HT: 'T=23.4 H=45.6' text notifications on 226caa55-...
+  - Govee H5080/H5082: key authorization, switch commands and STATE
+    replies on the tx/rx characteristics, and the wait-for-secret exchange
+    while the device is pairing
+  - SwitchBot (and Plus): service data frames in advertisements, as are
+    the Govee outlet states
+
+Latency, dropped notifications, connect failures and link loss can all be
+injected, with a seeded random generator for repeatable runs.
+
+    fleet = Fleet(latency=0.05, drop=0.01, failure=0.02)
+    fleet.populate({'miflora': 100, 'h5082': 20, 'switchbot': 50})
+    fleet.install()
+    ...
+    for device, advertisement in fleet.advertisements():
+        ...
+
+Run as a script, it drives the polling plugins, the connection scheduler,
+the outlet plugins and both pipelines against a fleet for a while, and
+prints the results:
+
+    python -m _bench.fleet [--seconds 60] [--scale 1] [--latency 0.05]
+        [--drop 0.01] [--failure 0.02] [--seed 1]
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+if __package__:
+    from . import stubs
+else:
+    import stubs
+
+
+MIFLORA_FIRMWARE = '00001a02-0000-1000-8000-00805f9b34fb'
+MIFLORA_MODE = '00001a00-0000-1000-8000-00805f9b34fb'
+MIFLORA_DATA = '00001a01-0000-1000-8000-00805f9b34fb'
+MJHT_DATA = '226caa55-6476-4566-7562-66734470666d'
+GOVEE_TX = '00010203-0405-0607-0809-0a0b0c0d2b11'
+GOVEE_RX = '00010203-0405-0607-0809-0a0b0c0d2b10'
+GOVEE_KEY = 34818
+SWITCHBOT = '0000fd3d-0000-1000-8000-00805f9b34fb'
+
+
+def checksum(data):
+    chksum = 0
+    for val in data:
+        chksum ^= val
+
+    return chksum
+
+
+def packet(data, size=20):
+    """
+    Pad a Govee packet and add its checksum
+    """
+
+    data = bytearray(data) + bytearray(size - len(data))
+    data[-1] = checksum(data[:-1])
+    return data
+
+
+class Session:
+    """
+    One connection to a simulated device
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.callbacks = {}
+        self.state = {}
+        self.tasks = []
+
+
+    def close(self):
+        for t in self.tasks:
+            t.cancel()
+        self.tasks = []
+        self.callbacks = {}
+
+
+class SimulatedDevice:
+    """
+    Base class for simulated devices. Subclasses answer reads and writes,
+    and build advertisements.
+    """
+
+    kind = None
+    prefix = 'AA:BB:CC'
+    local_name = None
+
+    def __init__(self, fleet, number):
+        self.fleet = fleet
+        self.number = number
+        self.address = "%s:%02X:%02X:%02X" % (self.prefix,
+            (number >> 16) & 0xff, (number >> 8) & 0xff, number & 0xff)
+        self.rng = random.Random(fleet.seed * 100003 + number)
+        self.session = None
+
+
+    @property
+    def name(self):
+        return self.local_name
+
+
+    def drift(self, value, step, low, high):
+        return min(high, max(low, value + self.rng.uniform(-step, step)))
+
+
+    def read(self, session, uuid):
+        raise stubs.BleakError("Characteristic %s not found" % uuid)
+
+
+    def write(self, session, uuid, data):
+        """
+        Handle a write
+        returns:
+            list of (uuid, data) notifications to send back
+        """
+
+        raise stubs.BleakError("Characteristic %s not found" % uuid)
+
+
+    def subscribed(self, session, uuid):
+        pass
+
+
+    def advertisement(self):
+        return None
+
+
+class MiFloraDevice(SimulatedDevice):
+    kind = 'miflora'
+    prefix = 'C4:7C:8D'
+    local_name = 'Flower care'
+
+    def __init__(self, fleet, number):
+        super().__init__(fleet, number)
+        self.firmware = self.rng.choice(['2.6.2', '3.2.1', '3.3.5'])
+        self.battery = self.rng.randint(20, 100)
+        self.temperature = self.rng.uniform(15, 30)
+        self.light = self.rng.randint(100, 20000)
+        self.moisture = self.rng.randint(10, 60)
+        self.conductivity = self.rng.randint(100, 1500)
+
+
+    def read(self, session, uuid):
+        if uuid == MIFLORA_FIRMWARE:
+            return bytearray([self.battery, 0x2b]) + self.firmware.encode()
+
+        if uuid == MIFLORA_DATA:
+            if self.firmware >= '2.6.6' and not session.state.get('mode'):
+                # newer firmware needs the mode change first
+                return bytearray(b'\xaa\xbb\xcc\xdd\xee\xff\x99\x88'
+                    b'\x77\x66\x00\x00\x00\x00\x00\x00')
+
+            self.temperature = self.drift(self.temperature, 0.3, -5, 45)
+            self.moisture = int(self.drift(self.moisture, 1, 0, 100))
+            data = bytearray(16)
+            data[0:2] = int(self.temperature * 10).to_bytes(2, 'little', signed=True)
+            data[3:7] = self.light.to_bytes(4, 'little')
+            data[7] = self.moisture
+            data[8:10] = self.conductivity.to_bytes(2, 'little')
+            return data
+
+        return super().read(session, uuid)
+
+
+    def write(self, session, uuid, data):
+        if uuid == MIFLORA_MODE:
+            if bytes(data) == b'\xa0\x1f':
+                session.state['mode'] = True
+            return []
+
+        return super().write(session, uuid, data)
+
+
+class MJHTDevice(SimulatedDevice):
+    kind = 'mjht'
+    prefix = '4C:65:A8'
+    local_name = 'MJ_HT_V1'
+
+    # seconds between measurement notifications
+    interval = 1.0
+
+    def __init__(self, fleet, number):
+        super().__init__(fleet, number)
+        self.temperature = self.rng.uniform(15, 30)
+        self.humidity = self.rng.uniform(30, 70)
+
+
+    def subscribed(self, session, uuid):
+        if uuid == MJHT_DATA:
+            session.tasks.append(asyncio.ensure_future(self._notify(session)))
+
+
+    async def _notify(self, session):
+        # first reading arrives at a random point in the cycle
+        await asyncio.sleep(self.rng.uniform(0, self.interval))
+        while True:
+            self.temperature = self.drift(self.temperature, 0.2, -10, 50)
+            self.humidity = self.drift(self.humidity, 0.5, 0, 99)
+            text = "T=%0.1f H=%0.1f\x00" % (self.temperature, self.humidity)
+            self.fleet.notify(session, MJHT_DATA, bytearray(text.encode()))
+            await asyncio.sleep(self.interval)
+
+
+class GoveeOutletDevice(SimulatedDevice):
+    kind = 'h5080'
+    prefix = 'A4:C1:38'
+    outlets = 1
+
+    # paired with a random key. set pairing to answer a wait-for-secret.
+    def __init__(self, fleet, number):
+        super().__init__(fleet, number)
+        self.key_code = [self.rng.randint(0, 255) for i in range(8)]
+        self.states = {o: 0 for o in range(1, self.outlets + 1)}
+        self.pairing = False
+        self.switches = 0
+
+
+    @property
+    def name(self):
+        return "ihoment_H%s_%04X" % (self.kind[1:], self.number & 0xffff)
+
+
+    def codes(self):
+        # {command byte: (outlet, state)}
+        return {0x11: (1, 1), 0x10: (1, 0)}
+
+
+    def write(self, session, uuid, data):
+        if uuid != GOVEE_TX:
+            return super().write(session, uuid, data)
+
+        data = bytes(data)
+        if len(data) != 20 or checksum(data):
+            return []
+
+        if data[:2] == b'\x33\xb2':
+            session.state['authorized'] = list(data[2:10]) == self.key_code
+            return []
+
+        if data[:2] == b'\x33\x01':
+            action = self.codes().get(data[2])
+            if action is None or not session.state.get('authorized'):
+                # unauthorized commands are silently ignored
+                return []
+
+            outlet, state = action
+            self.states[outlet] = state
+            self.switches += 1
+            return [(GOVEE_RX, packet(b'\xaa\x01' + bytes([state, self.bits()])))]
+
+        if data[:2] == b'\xaa\xb1':
+            if not self.pairing:
+                return []
+            return [(GOVEE_RX, packet(b'\xaa\xb1\x01' + bytes(self.key_code)))]
+
+        return []
+
+
+    def bits(self):
+        return self.states[1]
+
+
+    def advertisement(self):
+        return SimpleNamespace(
+            local_name=self.name,
+            service_data={},
+            manufacturer_data={GOVEE_KEY: bytes([0xec, 0, 1, 1, 1, self.bits()])},
+            rssi=-self.rng.randint(40, 90))
+
+
+class GoveeDualOutletDevice(GoveeOutletDevice):
+    kind = 'h5082'
+    outlets = 2
+
+    def codes(self):
+        return {0x23: (1, 1), 0x20: (1, 0), 0x11: (2, 1), 0x10: (2, 0)}
+
+
+    def bits(self):
+        return (self.states[1] << 1) | self.states[2]
+
+
+class SwitchbotDevice(SimulatedDevice):
+    kind = 'switchbot'
+    prefix = 'EB:B3:0E'
+    model = 0x54
+
+    def __init__(self, fleet, number):
+        super().__init__(fleet, number)
+        self.battery = self.rng.randint(20, 100)
+        self.temperature = self.rng.uniform(-5, 35)
+        self.humidity = self.rng.uniform(30, 70)
+
+
+    @property
+    def name(self):
+        return self.address.replace(':', '-')
+
+
+    def advertisement(self):
+        self.temperature = self.drift(self.temperature, 0.1, -20, 60)
+        self.humidity = self.drift(self.humidity, 0.3, 0, 99)
+        whole, tenths = divmod(round(abs(self.temperature) * 10), 10)
+        sign = 0x80 if self.temperature >= 0 else 0
+        frame = bytes([self.model, 0, self.battery, tenths,
+            sign | min(whole, 0x7f), int(self.humidity)])
+        return SimpleNamespace(
+            local_name=None,
+            service_data={SWITCHBOT: frame},
+            manufacturer_data={},
+            rssi=-self.rng.randint(40, 90))
+
+
+class SwitchbotPlusDevice(SwitchbotDevice):
+    kind = 'switchbot_plus'
+    prefix = 'E5:83:33'
+    model = 0x69
+
+
+DEVICES = {d.kind: d for d in (MiFloraDevice, MJHTDevice, GoveeOutletDevice,
+    GoveeDualOutletDevice, SwitchbotDevice, SwitchbotPlusDevice)}
+
+
+class FleetClient:
+    """
+    BleakClient for simulated devices. Fleet.install() makes a subclass
+    bound to the fleet.
+    """
+
+    fleet = None
+
+    def __init__(self, address, disconnected_callback=None, **kwargs):
+        self.address = address
+        self.is_connected = False
+        self._disconnected_callback = disconnected_callback
+        self._session = None
+
+
+    async def connect(self, **kwargs):
+        fleet = self.fleet
+        device = fleet.devices.get(self.address.upper())
+        await fleet.delay()
+        fleet.stats['connects'] += 1
+        if device is None:
+            fleet.stats['connect_failures'] += 1
+            raise stubs.BleakError("Device with address %s was not found" %
+                self.address)
+
+        if fleet.chance(fleet.failure):
+            fleet.stats['connect_failures'] += 1
+            raise stubs.BleakError("Simulated connect failure %s" % self.address)
+
+        if device.session is not None:
+            # a device takes one connection at a time
+            fleet.stats['connect_failures'] += 1
+            raise stubs.BleakError("Device %s is busy" % self.address)
+
+        self._session = Session(self)
+        device.session = self._session
+        self.is_connected = True
+        return True
+
+
+    async def disconnect(self):
+        if self.is_connected:
+            await self.fleet.delay()
+            self._close()
+        return True
+
+
+    def _close(self):
+        self.is_connected = False
+        session = self._session
+        self._session = None
+        if session is None:
+            return
+
+        session.close()
+        device = self.fleet.devices.get(self.address.upper())
+        if device is not None and device.session is session:
+            device.session = None
+
+        if self._disconnected_callback is not None:
+            self._disconnected_callback(self)
+
+
+    async def _operation(self):
+        """
+        Common start of every GATT operation
+        returns:
+            (device, session)
+        """
+
+        fleet = self.fleet
+        if not self.is_connected:
+            raise stubs.BleakError("Not connected")
+
+        await fleet.delay()
+        if not self.is_connected:
+            raise stubs.BleakError("Not connected")
+
+        if fleet.chance(fleet.link_loss):
+            fleet.stats['link_losses'] += 1
+            self._close()
+            raise stubs.BleakError("Simulated link loss %s" % self.address)
+
+        return (fleet.devices[self.address.upper()], self._session)
+
+
+    async def read_gatt_char(self, uuid, **kwargs):
+        device, session = await self._operation()
+        self.fleet.stats['reads'] += 1
+        return device.read(session, uuid)
+
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        device, session = await self._operation()
+        self.fleet.stats['writes'] += 1
+        for reply_uuid, reply in device.write(session, uuid, data):
+            self.fleet.notify(session, reply_uuid, reply)
+
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        device, session = await self._operation()
+        session.callbacks[uuid] = callback
+        device.subscribed(session, uuid)
+
+
+    async def stop_notify(self, uuid):
+        if self._session is not None:
+            self._session.callbacks.pop(uuid, None)
+
+
+class Fleet:
+    """
+    A set of simulated devices, and the fault injection settings shared by
+    all of them.
+
+    latency is seconds per GATT operation, with up to jitter seconds added
+    at random. drop is the probability of losing a notification, failure
+    of a connect attempt failing, and link_loss of the link dropping
+    during any GATT operation.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.drop = 0.0
+        self.failure = 0.0
+        self.link_loss = 0.0
+        self.seed = 0
+        for k, v in kwargs.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+
+        self.rng = random.Random(self.seed)
+        self.devices = {}
+        self.stats = {
+            'connects': 0,
+            'connect_failures': 0,
+            'link_losses': 0,
+            'reads': 0,
+            'writes': 0,
+            'notifications': 0,
+            'dropped': 0 }
+        self._counter = 0
+        self._patched = []
+
+
+    def add(self, kind, count=1):
+        """
+        Add simulated devices
+        args:
+            - device kind, one of DEVICES
+            - number of devices
+        returns:
+            list of new devices
+        """
+
+        added = []
+        for i in range(count):
+            self._counter += 1
+            device = DEVICES[kind](self, self._counter)
+            self.devices[device.address] = device
+            added.append(device)
+
+        return added
+
+
+    def populate(self, counts:dict):
+        """
+        Add devices of several kinds
+        args:
+            - dict of {kind: count}
+        """
+
+        for kind, count in counts.items():
+            self.add(kind, count)
+
+
+    def by_kind(self, kind):
+        return [d for d in self.devices.values() if d.kind == kind]
+
+
+    def chance(self, probability):
+        return probability > 0 and self.rng.random() < probability
+
+
+    async def delay(self):
+        seconds = self.latency
+        if self.jitter:
+            seconds += self.rng.uniform(0, self.jitter)
+        await asyncio.sleep(seconds)
+
+
+    def notify(self, session, uuid, data):
+        """
+        Send a notification to a connected client, after the fleet latency
+        """
+
+        if self.chance(self.drop):
+            self.stats['dropped'] += 1
+            return
+
+        async def send():
+            await self.delay()
+            callback = session.callbacks.get(uuid)
+            if callback is not None:
+                self.stats['notifications'] += 1
+                callback(uuid, data)
+
+        session.tasks = [t for t in session.tasks if not t.done()]
+        session.tasks.append(asyncio.ensure_future(send()))
+
+
+    def advertisements(self, kinds=None):
+        """
+        Get one advertisement from every advertising device
+        args:
+            - list of device kinds (optional. default is all)
+        returns:
+            list of (device, advertisement) tuples, as passed to
+            read_advertisement
+        """
+
+        results = []
+        for d in self.devices.values():
+            if kinds is not None and d.kind not in kinds:
+                continue
+
+            advertisement = d.advertisement()
+            if advertisement is not None:
+                results.append((SimpleNamespace(address=d.address,
+                    name=d.name), advertisement))
+
+        return results
+
+
+    async def scan(self, interval=1.0, kinds=None):
+        """
+        Generate advertisements from every advertising device, every
+        interval seconds, spread over the interval
+        """
+
+        while True:
+            batch = self.advertisements(kinds)
+            if not batch:
+                await asyncio.sleep(interval)
+                continue
+
+            pause = interval / len(batch)
+            for item in batch:
+                yield item
+                await asyncio.sleep(pause)
+
+
+    def install(self):
+        """
+        Make every loaded module use this fleet's client as BleakClient
+        """
+
+        stubs.install()
+        original = sys.modules['bleak'].BleakClient
+        client = type('FleetClient', (FleetClient,), {'fleet': self})
+        for module in list(sys.modules.values()):
+            if module is stubs:
+                continue
+            if getattr(module, 'BleakClient', None) is original:
+                self._patched.append((module, original))
+                module.BleakClient = client
+
+        self.client = client
+        return client
+
+
+    def uninstall(self):
+        for module, original in reversed(self._patched):
+            module.BleakClient = original
+        self._patched = []
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+async def load_test(fleet, seconds=30, interval=5.0, switches=0.2):
+    """
+    Run the plugins against a fleet. Each polled device is polled every
+    interval seconds, advertisements are fed to their plugins, outlets are
+    switched at random, and every measurement goes through both pipelines.
+    args:
+        - Fleet (populated and installed)
+        - seconds to run
+        - seconds between polls of each device
+        - outlet switches per outlet per interval
+    returns:
+        dict of results
+    """
+
+    from _lib.ble import scheduler, pool
+    miflora = stubs.load('device/ble/xiaomi_miflora.py').MiFlora
+    mjht = stubs.load('device/ble/xiaomi_mjht.py').XiaomiMJHT
+    h5080 = stubs.load('device/ble/govee_h5080_outlet.py').GoveeH5080
+    h5082 = stubs.load('device/ble/govee_h5082_outlet.py').GoveeH5082
+    database = stubs.install()
+    DBPipeline = stubs.load('pipeline/db.py').DBPipeline
+    ControlPipeline = stubs.load('pipeline/controls.py').ControlPipeline
+    switchbots = [stubs.load(p).__dict__[n] for p, n in (
+        ('device/ble/switchbot_hygrometer.py', 'SwitchbotHygrometer'),
+        ('device/ble/switchbot_plus_hygrometer.py', 'SwitchbotPlusHygrometer'))]
+    plugins = {'miflora': miflora, 'mjht': mjht, 'h5080': h5080,
+        'h5082': h5082, 'switchbot': switchbots[0],
+        'switchbot_plus': switchbots[1]}
+
+    ids = {address: i for i, address in enumerate(fleet.devices, 1)}
+
+    # a control per outlet, driven by the temperature of a random sensor
+    from potnanny.models.control import Control
+    sensors = [d for d in fleet.devices.values()
+        if d.kind not in ('h5080', 'h5082')]
+    for d in fleet.devices.values():
+        if d.kind in ('h5080', 'h5082') and sensors:
+            await Control.create(name=d.address, device_id=ids[d.address],
+                outlet=1, attributes={
+                    'input_device_id': ids[fleet.rng.choice(sensors).address],
+                    'type': 'temperature',
+                    'on': {'condition': '<', 'threshold': 18},
+                    'off': {'condition': '>', 'threshold': 26}})
+    results = {'polls': 0, 'poll_failures': 0, 'poll_times': [],
+        'adverts': 0, 'measurements': 0, 'switches': 0,
+        'switch_unconfirmed': 0, 'switch_times': []}
+    deadline = time.monotonic() + seconds
+
+    async def pipelines(device_id, values):
+        rows = [{'device_id': device_id, 'type': k, 'value': v}
+            for k, v in values.items()]
+        results['measurements'] += len(rows)
+        await DBPipeline().input([dict(r) for r in rows])
+        await ControlPipeline().input(rows)
+
+    async def pause(seconds):
+        # never sleep past the end of the run
+        await asyncio.sleep(max(0, min(seconds, deadline - time.monotonic())))
+
+    async def poller(device):
+        await pause(fleet.rng.uniform(0, interval))
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            values = None
+            try:
+                values = await plugins[device.kind](address=device.address).poll()
+            except Exception:
+                pass
+
+            results['polls'] += 1
+            if values:
+                results['poll_times'].append(time.monotonic() - started)
+                await pipelines(ids[device.address], values)
+            else:
+                results['poll_failures'] += 1
+            await pause(interval)
+
+    async def switcher(device):
+        while time.monotonic() < deadline:
+            await pause(fleet.rng.expovariate(switches / interval))
+            if time.monotonic() >= deadline:
+                break
+            outlet = fleet.rng.randint(1, device.outlets)
+            plugin = plugins[device.kind](address=device.address,
+                key_code=device.key_code)
+            started = time.monotonic()
+            try:
+                rval = await plugin.set_state(outlet, fleet.rng.randint(0, 1))
+            except Exception:
+                rval = -1
+
+            results['switches'] += 1
+            if rval == -1:
+                results['switch_unconfirmed'] += 1
+            else:
+                results['switch_times'].append(time.monotonic() - started)
+
+    async def scanner():
+        kinds = ['h5080', 'h5082', 'switchbot', 'switchbot_plus']
+        instances = {}
+        async for device, advertisement in fleet.scan(interval, kinds):
+            if time.monotonic() >= deadline:
+                return
+
+            kind = fleet.devices[device.address].kind
+            if kind not in instances:
+                instances[kind] = plugins[kind](address=device.address)
+            values = instances[kind].read_advertisement(device, advertisement)
+            results['adverts'] += 1
+            if values:
+                await pipelines(ids[device.address], values)
+
+    tasks = [poller(d) for d in fleet.devices.values()
+        if d.kind in ('miflora', 'mjht')]
+    tasks += [switcher(d) for d in fleet.devices.values()
+        if d.kind in ('h5080', 'h5082')]
+    tasks.append(scanner())
+    await asyncio.gather(*tasks)
+    await pool.close()
+
+    poll_times = results.pop('poll_times')
+    switch_times = results.pop('switch_times')
+    waits = [s['queue_wait_total'] / s['queue_wait_count']
+        for s in scheduler.stats.values() if s.get('queue_wait_count')]
+    results.update({
+        'poll_p50': percentile(poll_times, 50),
+        'poll_p95': percentile(poll_times, 95),
+        'switch_p50': percentile(switch_times, 50),
+        'switch_p95': percentile(switch_times, 95),
+        'queue_wait_mean_p95': percentile(waits, 95),
+        'rows_inserted': database.count(),
+        'control_switches': Control.switched,
+        'fleet': dict(fleet.stats) })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the plugins "
+        "against a simulated device fleet")
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=30.0,
+        help="seconds between polls of each device")
+    parser.add_argument('--scale', type=float, default=1.0,
+        help="multiply the default device counts")
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--drop', type=float, default=0.01)
+    parser.add_argument('--failure', type=float, default=0.02)
+    parser.add_argument('--link-loss', type=float, default=0.005)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    counts = {'miflora': 60, 'mjht': 40, 'h5080': 10, 'h5082': 10,
+        'switchbot': 90, 'switchbot_plus': 90}
+    fleet = Fleet(latency=args.latency, jitter=args.jitter, drop=args.drop,
+        failure=args.failure, link_loss=args.link_loss, seed=args.seed)
+    fleet.populate({k: max(1, int(v * args.scale)) for k, v in counts.items()})
+    fleet.install()
+
+    results = asyncio.run(load_test(fleet, args.seconds, args.interval))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
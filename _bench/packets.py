@@ -0,0 +1,141 @@
+"""
+Micro-benchmark of Govee outlet packet building and validation.
+
+Compares the original PacketManager code path (list comprehension padding,
+sliced copies and a Python XOR loop, on every command) with the current
+one (precomputed command templates, memoryview checksums).
+
+    python _bench/packets.py [seconds]
+"""
+
+import sys
+import time
+
+if __package__:
+    from . import stubs
+else:
+    import stubs
+
+
+class OriginalPacketManager:
+    """
+    PacketManager as it was before the command templates, for comparison
+    """
+
+    default_sz = 20
+
+    def validate(self, data, size=None, contains_chksum=True):
+        if size is None:
+            size = self.default_sz
+
+        if type(data) != bytearray:
+            return False
+
+        if len(data) != size:
+            return False
+
+        if contains_chksum:
+            check = data[-1]
+            chksum = self.get_checksum(data[:(size - 1)])
+            if chksum != check:
+                return False
+
+        return True
+
+
+    def get_checksum(self, data):
+        chksum = 0
+        for val in data:
+            chksum ^= val
+
+        return chksum
+
+
+    def build(self, data, size=None, add_chksum=True):
+        if size is None:
+            size = self.default_sz
+
+        if len(data) < size:
+            data += bytearray([0 for i in range(0, (size - len(data)))])
+
+        if add_chksum:
+            chksum = self.get_checksum(data[:(size - 1)])
+            data[-1] = chksum
+
+        return data
+
+
+def rate(func, seconds):
+    """
+    Call func repeatedly for about this many seconds
+    returns:
+        calls per second
+    """
+
+    count = 0
+    started = time.perf_counter()
+    elapsed = 0
+    while elapsed < seconds:
+        for i in range(1000):
+            func()
+        count += 1000
+        elapsed = time.perf_counter() - started
+
+    return count / elapsed
+
+
+def run(seconds=1.0):
+    """
+    Run the benchmark
+    returns:
+        dict of {case: packets per second}
+    """
+
+    govee = stubs.load('device/ble/govee_h5082_outlet.py')
+    code = govee.H5082Code
+    old = OriginalPacketManager()
+    new = govee.PacketManager(default_sz=20)
+    notification = bytearray(code.SWITCH_PACKETS[(1, 1)])
+
+    def build_before():
+        old.build(bytearray(code.SWITCH + code.ON1))
+
+    def build_after():
+        code.SWITCH_PACKETS[(1, 1)]
+
+    key_code = bytearray(range(8))
+
+    def key_before():
+        old.build(bytearray(code.send_key + key_code))
+
+    def key_after():
+        new.build(bytearray(code.send_key + key_code))
+
+    def validate_before():
+        old.validate(notification)
+
+    def validate_after():
+        new.validate(notification)
+
+    # both paths must produce the same packets
+    assert old.build(bytearray(code.send_key + key_code)) == \
+        new.build(bytearray(code.send_key + key_code))
+    assert bytes(old.build(bytearray(code.SWITCH + code.ON1))) == code.SWITCH_PACKETS[(1, 1)]
+
+    return {
+        'build_before': rate(build_before, seconds),
+        'build_after': rate(build_after, seconds),
+        'key_before': rate(key_before, seconds),
+        'key_after': rate(key_after, seconds),
+        'validate_before': rate(validate_before, seconds),
+        'validate_after': rate(validate_after, seconds) }
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    results = run(seconds)
+    for case in ('build', 'key', 'validate'):
+        before = results[case + '_before']
+        after = results[case + '_after']
+        print("%-9s before %12.0f/s  after %12.0f/s  (%0.1fx)" % (
+            case, before, after, after / before))
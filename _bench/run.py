@@ -0,0 +1,494 @@
+"""
+Benchmark suite for the plugins.
+
+Runs offline, against the stand-ins in _bench/stubs.py, and measures the
+throughput of advertisement decoding, packet handling and both pipelines.
+Results are written as JSON, so runs on different commits can be compared.
+
+    python -m _bench.run [--seconds 1] [--repeat 3] [--only NAME]
+        [--output FILE] [--compare BASELINE.json] [--threshold 0.8]
+
+With --compare, each case is reported against the baseline file, and the
+exit status is 1 if any case fell below threshold x its baseline rate.
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import platform
+import subprocess
+from types import SimpleNamespace
+
+if __package__:
+    from . import stubs
+else:
+    import stubs
+
+
+CASES = []
+
+
+def case(name, unit='calls'):
+    """
+    Register a benchmark case. The function is called (or awaited) once to
+    set up, and returns a (func, units_per_call) tuple. func is called
+    repeatedly, and may be a coroutine function. A third item in the tuple
+    is a function returning extra values for the results.
+    """
+
+    def register(setup):
+        CASES.append((name, unit, setup))
+        return setup
+
+    return register
+
+
+# Sample advertisements, by plugin class name. Each is a function of a
+# counter, so successive calls can be given different payloads.
+SWITCHBOT = '0000fd3d-0000-1000-8000-00805f9b34fb'
+GOVEE = 34818
+ADVERTISEMENTS = {
+    'SwitchbotHygrometer': lambda i: SimpleNamespace(
+        service_data={SWITCHBOT: bytes([0x54, 0, 0x5a, i % 10, 0x96, 40 + i % 30])},
+        manufacturer_data={}, local_name=None),
+    'SwitchbotPlusHygrometer': lambda i: SimpleNamespace(
+        service_data={SWITCHBOT: bytes([0x69, 0, 0x5a, i % 10, 0x96, 40 + i % 30])},
+        manufacturer_data={}, local_name=None),
+    'GoveeH5080': lambda i: SimpleNamespace(
+        service_data={},
+        manufacturer_data={GOVEE: bytes([0xec, 0, 1, 1, 1, i % 2])},
+        local_name='ihoment_H5080_1A2B'),
+    'GoveeH5082': lambda i: SimpleNamespace(
+        service_data={},
+        manufacturer_data={GOVEE: bytes([0xec, 0, 1, 1, 1, i % 4])},
+        local_name='ihoment_H5082_1A2B'),
+}
+
+DEVICE_PLUGINS = [
+    'device/ble/switchbot_hygrometer.py',
+    'device/ble/switchbot_plus_hygrometer.py',
+    'device/ble/govee_h5080_outlet.py',
+    'device/ble/govee_h5082_outlet.py',
+    'device/ble/xiaomi_miflora.py',
+    'device/ble/xiaomi_mjht.py',
+]
+
+TYPES = ['temperature', 'humidity', 'soil_moisture', 'light']
+
+
+def advertisement_plugins():
+    """
+    Get every loaded plugin class with a read_advertisement method
+    """
+
+    from potnanny.plugins import BluetoothDevicePlugin
+    for path in DEVICE_PLUGINS:
+        stubs.load(path)
+
+    return [p for p in BluetoothDevicePlugin.plugins
+        if hasattr(p, 'read_advertisement')]
+
+
+def advertisement_cases():
+    for klass in advertisement_plugins():
+        sample = ADVERTISEMENTS.get(klass.__name__)
+        if sample is None:
+            print("No sample advertisement for %s, skipped" % klass.__name__,
+                file=sys.stderr)
+            continue
+
+        def decode(klass=klass, sample=sample):
+            # a negative heartbeat makes every payload decode again
+            device = SimpleNamespace(address='AA:BB:CC:DD:EE:01', name=None)
+            plugin = klass(address=device.address)
+            plugin.heartbeat = -1
+            adverts = [sample(i) for i in range(64)]
+            count = iter(range(1 << 62))
+            def func():
+                plugin.read_advertisement(device, adverts[next(count) & 63])
+            return func, 1
+
+        def dedup(klass=klass, sample=sample):
+            device = SimpleNamespace(address='AA:BB:CC:DD:EE:02', name=None)
+            plugin = klass(address=device.address)
+            advert = sample(0)
+            def func():
+                plugin.read_advertisement(device, advert)
+            return func, 1
+
+        case('read_advertisement.%s' % klass.__name__, 'adverts')(decode)
+        case('read_advertisement.%s.dedup' % klass.__name__, 'adverts')(dedup)
+
+
+@case('miflora._decode_measurements', 'reads')
+def miflora_decode():
+    module = stubs.load('device/ble/xiaomi_miflora.py')
+    plugin = module.MiFlora(address='C4:7C:8D:00:00:01')
+    data = bytearray(b'\xe6\x00\x00\x8f\x01\x00\x00\x1c\x95\x01\x02<\x00\x00\x00\x00')
+    return (lambda: plugin._decode_measurements(data)), 1
+
+
+@case('packet.switch', 'packets')
+def packet_switch():
+    module = stubs.load('device/ble/govee_h5082_outlet.py')
+    packets = module.H5082Code.SWITCH_PACKETS
+    return (lambda: packets[(1, 1)]), 1
+
+
+@case('packet.build_key', 'packets')
+def packet_build():
+    module = stubs.load('device/ble/govee_h5082_outlet.py')
+    manager = module.PacketManager(default_sz=20)
+    prefix = module.H5082Code.send_key
+    key = bytearray(range(8))
+    return (lambda: manager.build(bytearray(prefix + key))), 1
+
+
+@case('packet.validate', 'packets')
+def packet_validate():
+    module = stubs.load('device/ble/govee_h5082_outlet.py')
+    manager = module.PacketManager(default_sz=20)
+    data = bytearray(module.H5082Code.SWITCH_PACKETS[(2, 0)])
+    return (lambda: manager.validate(data)), 1
+
+
+@case('metrics.disabled', 'calls')
+def metrics_disabled():
+    from _lib.metrics import Registry
+    registry = Registry(enabled=False)
+    counter = registry.counter('bench_total', "bench", ['plugin'])
+    histogram = registry.histogram('bench_seconds', "bench", ['plugin'])
+
+    def func():
+        with histogram.time(plugin='bench'):
+            counter.inc(plugin='bench')
+
+    return func, 1
+
+
+def measurements(device_id, types=TYPES):
+    now = datetime.datetime.utcnow()
+    return [{'device_id': device_id, 'type': t, 'value': random.uniform(0, 100),
+        'created': now} for t in types]
+
+
+def validate_case(marshmallow):
+    def setup():
+        stubs.install()
+        from _lib.measurement import validate
+        from potnanny.models.measurement import MeasurementSchema
+        batch = []
+        for device_id in range(1, 13):
+            batch += measurements(device_id)
+
+        if marshmallow:
+            def func():
+                MeasurementSchema(many=True).load(batch)
+        else:
+            def func():
+                validate(batch)
+
+        return func, len(batch)
+
+    return setup
+
+
+# validation of one 48 measurement pipeline batch
+case('validate.marshmallow', 'measurements')(validate_case(True))
+case('validate.records', 'measurements')(validate_case(False))
+
+
+@case('batch.from_dicts', 'measurements')
+def batch_from_dicts():
+    from _lib.measurement import MeasurementBatch
+    batch = []
+    for device_id in range(1, 13):
+        batch += measurements(device_id)
+
+    def func():
+        MeasurementBatch.from_dicts(batch)
+
+    return func, len(batch)
+
+
+def db_case(bulk, columnar=False):
+    def setup():
+        from _lib.measurement import MeasurementBatch
+        module = stubs.load('pipeline/db.py')
+        klass = module.DBPipeline
+        klass.bulk = bulk
+        klass.write_behind = False
+        klass.marshmallow = False
+        klass.deadband = None
+        klass.deadbands = {}
+        stubs.install().delay = 0
+        batch = []
+        for device_id in range(1, 13):
+            batch += measurements(device_id)
+
+        if columnar:
+            async def func():
+                await klass().input(MeasurementBatch.from_dicts(batch))
+        else:
+            async def func():
+                await klass().input([dict(m) for m in batch])
+
+        return func, len(batch)
+
+    return setup
+
+
+case('db_pipeline.bulk', 'measurements')(db_case(True))
+case('db_pipeline.bulk.batch', 'measurements')(db_case(True, True))
+case('db_pipeline.rows', 'measurements')(db_case(False))
+
+
+@case('db_pipeline.deadband', 'measurements')
+def db_deadband():
+    # slow moving sensors. values wander by up to 0.2 per reading, with a
+    # deadband of 0.5, so most readings are not saved.
+    module = stubs.load('pipeline/db.py')
+    klass = module.DBPipeline
+    klass.bulk = True
+    klass.write_behind = False
+    klass.deadband = 0.5
+    klass.deadbands = {}
+    klass._last = {}
+    klass.filtered = 0
+    database = stubs.install()
+    database.delay = 0
+    database.clear()
+    batch = []
+    for device_id in range(1, 13):
+        batch += measurements(device_id)
+
+    async def func():
+        for m in batch:
+            m['value'] += random.uniform(-0.2, 0.2)
+        await klass().input([dict(m) for m in batch])
+
+    def extra():
+        saved = database.count()
+        return {'saved_ratio': saved / (saved + klass.filtered)}
+
+    return func, len(batch), extra
+
+
+def lock_case(dedicated):
+    async def setup():
+        from potnanny.database import lock
+        module = stubs.load('pipeline/db.py')
+        klass = module.DBPipeline
+        await klass.shutdown()
+        stubs.install().delay = 0.001
+        klass.bulk = True
+        klass.write_behind = True
+        klass.dedicated_writer = dedicated
+        klass.flush_rows = 48
+        batch = measurements(1) * 12
+        waits = []
+
+        async def func():
+            # another user of the global lock, while measurements are written
+            await klass().input([dict(m) for m in batch])
+            flushed = asyncio.ensure_future(klass.flush())
+            await asyncio.sleep(0.002)
+            started = time.perf_counter()
+            async with lock:
+                waits.append(time.perf_counter() - started)
+            await flushed
+
+        def extra():
+            waits.sort()
+            return {
+                'lock_wait_mean': sum(waits) / len(waits),
+                'lock_wait_p95': waits[int(len(waits) * 0.95)] }
+
+        return func, len(batch), extra
+
+    return setup
+
+
+# lock wait seen by other components, with the global lock writer and the
+# dedicated writer. the database yields for 1ms per statement.
+case('db_pipeline.lock_wait.shared', 'measurements')(lock_case(False))
+case('db_pipeline.lock_wait.dedicated', 'measurements')(lock_case(True))
+
+
+def control_case(devices, controls, columnar=False):
+    def setup():
+        from _lib.measurement import MeasurementBatch
+        from potnanny.models.control import Control
+        module = stubs.load('pipeline/controls.py')
+        klass = module.ControlPipeline
+
+        rng = random.Random(controls)
+        Control.rows[:] = []
+        for i in range(controls):
+            Control.rows.append(Control(id=i + 1, name='control %d' % i,
+                device_id=1000 + i, outlet=1, attributes={
+                    'input_device_id': rng.randint(1, devices),
+                    'type': rng.choice(TYPES),
+                    'on': {'condition': '<', 'threshold': 40},
+                    'off': {'condition': '>', 'threshold': 60}}))
+        klass.invalidate()
+
+        batches = [measurements(d) for d in range(1, devices + 1)]
+        if columnar:
+            batches = [MeasurementBatch.from_dicts(b) for b in batches]
+        count = iter(range(1 << 62))
+
+        async def func():
+            await klass().input(batches[next(count) % devices])
+
+        return func, len(TYPES)
+
+    return setup
+
+
+case('control_pipeline.d10_c10', 'measurements')(control_case(10, 10))
+case('control_pipeline.d50_c200', 'measurements')(control_case(50, 200))
+case('control_pipeline.d50_c200.batch', 'measurements')(
+    control_case(50, 200, True))
+
+
+async def measure(func, seconds):
+    """
+    Call func repeatedly for about this many seconds
+    returns:
+        (calls, elapsed seconds)
+    """
+
+    is_async = asyncio.iscoroutinefunction(func)
+    calls = 0
+    started = time.perf_counter()
+    elapsed = 0
+    while elapsed < seconds:
+        if is_async:
+            for i in range(50):
+                await func()
+            calls += 50
+        else:
+            for i in range(1000):
+                func()
+            calls += 1000
+        elapsed = time.perf_counter() - started
+
+    return calls, elapsed
+
+
+async def run(seconds=1.0, only=None, repeat=3):
+    """
+    Run the benchmark cases
+    args:
+        - seconds per case, per round
+        - only run cases with this substring in the name (optional)
+        - rounds per case. The best round is kept, which filters out most
+          noise from other work on the machine.
+    returns:
+        dict of {case name: result dict}
+    """
+
+    stubs.install()
+    advertisement_cases()
+    results = {}
+    for name, unit, setup in CASES:
+        if only and only not in name:
+            continue
+
+        if asyncio.iscoroutinefunction(setup):
+            prepared = await setup()
+        else:
+            prepared = setup()
+        func, units = prepared[:2]
+        await measure(func, seconds / 10)
+        rates = []
+        for i in range(repeat):
+            calls, elapsed = await measure(func, seconds)
+            rates.append(calls * units / elapsed)
+
+        results[name] = {
+            'unit': unit,
+            'rate': max(rates),
+            'rates': rates }
+        if len(prepared) > 2:
+            results[name].update(prepared[2]())
+        print("%-48s %14.0f %s/s" % (name, results[name]['rate'], unit),
+            file=sys.stderr)
+
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=stubs.ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each case against a baseline run
+    returns:
+        list of regressed case names
+    """
+
+    regressed = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            continue
+
+        ratio = result['rate'] / before['rate']
+        flag = ''
+        if ratio < threshold:
+            flag = '  REGRESSED'
+            regressed.append(name)
+        print("%-48s %6.2fx%s" % (name, ratio, flag))
+
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run plugin benchmarks")
+    parser.add_argument('--seconds', type=float, default=1.0,
+        help="seconds to run each case")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="rounds per case, the best is kept")
+    parser.add_argument('--only', help="only run cases matching this")
+    parser.add_argument('--output', default='bench.json',
+        help="JSON results file")
+    parser.add_argument('--compare', help="baseline JSON results file")
+    parser.add_argument('--threshold', type=float, default=0.8,
+        help="rate ratio below which a case counts as regressed")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.seconds, args.only, args.repeat))
+    report = {
+        'commit': commit(),
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seconds': args.seconds,
+        'repeat': args.repeat,
+        'results': results }
+
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,444 @@
+"""
+Offline stand-ins for the modules plugins import at runtime.
+
+install() puts these in sys.modules, before any plugin is loaded:
+
+  - bleak: a BleakClient that never touches a bluetooth adapter (see
+    _bench/fleet.py for one that emulates the devices)
+  - potnanny.database: db and lock, over an in-memory SQLite database
+  - potnanny.models.measurement: Measurement and MeasurementSchema
+  - potnanny.models.control: Control, which evaluates measurements like
+    the real model, but counts switch commands instead of sending them
+
+The potnanny plugin base classes are used as installed. If potnanny is
+not installed at all, minimal copies of them are used instead.
+"""
+
+import os
+import sys
+import types
+import asyncio
+import sqlite3
+import datetime
+import importlib.util
+import importlib.machinery
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BleakError(Exception):
+    pass
+
+
+class BleakClient:
+    """
+    Client that connects instantly, and has nothing to say
+    """
+
+    def __init__(self, address, disconnected_callback=None, **kwargs):
+        self.address = address
+        self.is_connected = False
+        self._disconnected_callback = disconnected_callback
+        self._notify = {}
+
+
+    async def connect(self, **kwargs):
+        self.is_connected = True
+        return True
+
+
+    async def disconnect(self):
+        was_connected = self.is_connected
+        self.is_connected = False
+        if was_connected and self._disconnected_callback is not None:
+            self._disconnected_callback(self)
+        return True
+
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        self._notify[uuid] = callback
+
+
+    async def stop_notify(self, uuid):
+        self._notify.pop(uuid, None)
+
+
+    async def read_gatt_char(self, uuid, **kwargs):
+        return bytearray(16)
+
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        pass
+
+
+class BleakScanner:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+    async def start(self):
+        pass
+
+
+    async def stop(self):
+        pass
+
+
+class Database:
+    """
+    Just enough of the potnanny Database for the pipelines. Nested
+    transactions are savepoints, as in peewee. Like aiosqlite, every
+    statement yields to the event loop (for delay seconds).
+    """
+
+    def __init__(self):
+        self.delay = 0
+        self.conn = sqlite3.connect(':memory:', isolation_level=None)
+        self.conn.execute("""
+            CREATE TABLE measurement (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type VARCHAR(24) NOT NULL,
+                value REAL NOT NULL,
+                created DATETIME NOT NULL,
+                device_id INTEGER NOT NULL)""")
+        self._depth = 0
+
+
+    def connection(self):
+        return _Connection()
+
+
+    def transaction(self):
+        return _Transaction(self)
+
+
+    def count(self, table='measurement'):
+        return self.conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+
+
+    def clear(self, table='measurement'):
+        self.conn.execute("DELETE FROM %s" % table)
+
+
+class _Connection:
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, kind, value, tb):
+        pass
+
+
+class _Transaction:
+    def __init__(self, database):
+        self.db = database
+        self.name = None
+
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.db.delay)
+        self.db._depth += 1
+        if self.db._depth == 1:
+            self.db.conn.execute("BEGIN")
+        else:
+            self.name = "sp%d" % self.db._depth
+            self.db.conn.execute("SAVEPOINT %s" % self.name)
+        return self
+
+
+    async def __aexit__(self, kind, value, tb):
+        await asyncio.sleep(self.db.delay)
+        self.db._depth -= 1
+        conn = self.db.conn
+        if self.name is None:
+            conn.execute("ROLLBACK" if kind else "COMMIT")
+        else:
+            if kind:
+                conn.execute("ROLLBACK TO %s" % self.name)
+            conn.execute("RELEASE %s" % self.name)
+
+
+class _Query:
+    """
+    Awaitable query, like a peewee_aio query
+    """
+
+    def __init__(self, delay, func, *args):
+        self.delay = delay
+        self.func = func
+        self.args = args
+
+
+    def __await__(self):
+        return self._run().__await__()
+
+
+    async def _run(self):
+        await asyncio.sleep(self.delay)
+        return self.func(*self.args)
+
+
+def _measurement_row(m):
+    created = m.get('created') or datetime.datetime.utcnow()
+    if isinstance(created, datetime.datetime):
+        created = created.isoformat()
+    return (m['type'], m['value'], created, m['device_id'])
+
+
+_INSERT = ("INSERT INTO measurement (type, value, created, device_id) "
+    "VALUES (?, ?, ?, ?)")
+
+
+def _measurement_module(database):
+    try:
+        from potnanny.models.schemas.safe import SafeSchema
+    except ImportError:
+        SafeSchema = None
+
+    import marshmallow
+    if SafeSchema is None:
+        class SafeSchema(marshmallow.Schema):
+            class Meta:
+                unknown = marshmallow.EXCLUDE
+
+    class MeasurementSchema(SafeSchema):
+        type = marshmallow.fields.String(allow_none=False)
+        value = marshmallow.fields.Float(allow_none=False)
+        created = marshmallow.fields.Raw(allow_none=True)
+        device_id = marshmallow.fields.Integer(allow_none=False)
+
+    class Measurement:
+        @classmethod
+        def insert_many(cls, rows, fields=None):
+            if fields is not None:
+                rows = [dict(zip(fields, r)) for r in rows]
+            return _Query(database.delay, database.conn.executemany, _INSERT,
+                [_measurement_row(m) for m in rows])
+
+
+        @classmethod
+        async def create(cls, **kwargs):
+            await asyncio.sleep(database.delay)
+            database.conn.execute(_INSERT, _measurement_row(kwargs))
+            obj = cls()
+            obj.__dict__.update(kwargs)
+            return obj
+
+    module = types.ModuleType('potnanny.models.measurement')
+    module.Measurement = Measurement
+    module.MeasurementSchema = MeasurementSchema
+    return module
+
+
+def _control_module():
+    try:
+        from potnanny.utils.eval import evaluate
+    except ImportError:
+        import operator
+        operators = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+            '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+
+        def evaluate(equation):
+            a, oper, b = equation.split()
+            return operators[oper](float(a), float(b))
+
+    class Control:
+        """
+        In-memory Control. Add rows to Control.rows, and count switch
+        commands in Control.switched.
+        """
+
+        rows = []
+        switched = 0
+        _ids = iter(range(1, 1 << 30))
+
+        def __init__(self, **kwargs):
+            self.id = None
+            self.name = None
+            self.outlet = 1
+            self.device_id = None
+            self.attributes = {}
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+
+
+        @classmethod
+        def select(cls):
+            return _Query(0, list, cls.rows)
+
+
+        @classmethod
+        async def create(cls, **kwargs):
+            obj = cls(**kwargs)
+            await obj.save()
+            return obj
+
+
+        async def save(self):
+            if self.id is None:
+                self.id = next(self._ids)
+                self.rows.append(self)
+
+
+        async def delete_instance(self):
+            if self in self.rows:
+                self.rows.remove(self)
+
+
+        async def input(self, data):
+            try:
+                if (data['device_id'] != self.attributes['input_device_id'] or
+                    data['type'] != self.attributes['type']):
+                    return
+            except Exception:
+                return
+
+            for key in ('on', 'off'):
+                working = self.attributes.get(key)
+                if not working:
+                    continue
+
+                equation = "%0.1f %s %s" % (float(data['value']),
+                    working['condition'], working['threshold'])
+                if evaluate(equation) is True:
+                    type(self).switched += 1
+
+    module = types.ModuleType('potnanny.models.control')
+    module.Control = Control
+    return module
+
+
+def _plugin_modules():
+    """
+    Minimal potnanny plugin base classes, for when potnanny is not
+    installed
+    """
+
+    class PluginBase(type):
+        def __init__(cls, name, bases, attrs):
+            if not hasattr(cls, 'plugins'):
+                cls.plugins = []
+            elif cls not in cls.plugins:
+                cls.plugins.append(cls)
+
+    class BluetoothDevicePlugin(metaclass=PluginBase):
+        pass
+
+    class PipelinePlugin(metaclass=PluginBase):
+        pass
+
+    class FingerprintMixin:
+        @classmethod
+        def recognize_this(cls, fp):
+            for key, regex in cls.fingerprint.items():
+                if key not in fp or not regex.search(fp[key]):
+                    return False
+            return True
+
+    base = types.ModuleType('potnanny.plugins.base')
+    base.BluetoothDevicePlugin = BluetoothDevicePlugin
+    base.PipelinePlugin = PipelinePlugin
+    mixins = types.ModuleType('potnanny.plugins.mixins')
+    mixins.FingerprintMixin = FingerprintMixin
+    plugins = types.ModuleType('potnanny.plugins')
+    plugins.__path__ = []
+    plugins.BluetoothDevicePlugin = BluetoothDevicePlugin
+    plugins.PipelinePlugin = PipelinePlugin
+    plugins.base = base
+    plugins.mixins = mixins
+    return {
+        'potnanny.plugins': plugins,
+        'potnanny.plugins.base': base,
+        'potnanny.plugins.mixins': mixins }
+
+
+_installed = None
+
+
+def install():
+    """
+    Install the stand-in modules. Safe to call more than once.
+    returns:
+        the stand-in Database
+    """
+
+    global _installed
+    if _installed is not None:
+        return _installed
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    modules = {}
+    try:
+        import potnanny.plugins
+        import potnanny.plugins.mixins
+    except ImportError:
+        for name in ('potnanny', 'potnanny.models'):
+            module = types.ModuleType(name)
+            module.__path__ = []
+            modules[name] = module
+        modules.update(_plugin_modules())
+
+    bleak = types.ModuleType('bleak')
+    bleak.__path__ = []
+    bleak.BleakClient = BleakClient
+    bleak.BleakScanner = BleakScanner
+    bleak.exc = types.ModuleType('bleak.exc')
+    bleak.exc.BleakError = BleakError
+    modules['bleak'] = bleak
+    modules['bleak.exc'] = bleak.exc
+
+    database = Database()
+    dbmodule = types.ModuleType('potnanny.database')
+    dbmodule.db = database
+    dbmodule.lock = asyncio.Lock()
+    modules['potnanny.database'] = dbmodule
+    modules['potnanny.models.measurement'] = _measurement_module(database)
+    modules['potnanny.models.control'] = _control_module()
+
+    sys.modules.update(modules)
+    _installed = database
+    return database
+
+
+def load(path):
+    """
+    Import a plugin module by path, relative to the repo root
+    args:
+        - path, like 'device/ble/govee_h5082_outlet.py'
+    returns:
+        module
+    """
+
+    install()
+    name = os.path.splitext(path)[0].replace('/', '.')
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.spec_from_file_location(name,
+        os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def reload(path):
+    """
+    Run a plugin file again, into a new module that is not imported by
+    name, the way potnanny's load_plugins does when the worker restarts.
+    The plugin classes are registered again.
+    args:
+        - path, like 'pipeline/controls.py'
+    returns:
+        module
+    """
+
+    install()
+    loader = importlib.machinery.SourceFileLoader('reloaded',
+        os.path.join(ROOT, path))
+    module = types.ModuleType(loader.name)
+    loader.exec_module(module)
+    return module
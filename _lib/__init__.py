@@ -0,0 +1,7 @@
+"""
+Shared helper code for the potnanny plugins.
+
+The potnanny plugin loader skips any file or directory that starts with an
+underscore, so nothing in here is loaded as a plugin. Plugins import it by
+name, which requires the plugin directory to be on the python path.
+"""
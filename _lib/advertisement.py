@@ -0,0 +1,66 @@
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdvertisementCache:
+    """
+    Remember the last raw advertisement payload from each device address,
+    and the values decoded from it.
+
+    BLE devices repeat identical advertisements many times a second. Plugins
+    check here before decoding, and return the cached values for payloads
+    that have not changed since they were last decoded. Every caller still
+    gets the reading (a poll right after a scan sees the same values), only
+    the decoding is skipped. Once the heartbeat window has passed, an
+    unchanged payload is decoded again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._seen = {}
+
+
+    def get(self, address, payload, heartbeat=60):
+        """
+        Get the values decoded from this payload, if it is the last payload
+        seen from the device.
+        args:
+            - device address (str)
+            - raw advertisement payload (bytes)
+            - seconds before an unchanged payload is decoded again
+        returns:
+            copy of the cached values dict, or None if the payload should
+            be decoded
+        """
+
+        last = self._seen.get(address)
+        if (last is not None and last[0] == payload and
+            time.monotonic() - last[1] < heartbeat):
+            return dict(last[2])
+
+        return None
+
+
+    def put(self, address, payload, values):
+        """
+        Remember the values decoded from a payload
+        args:
+            - device address (str)
+            - raw advertisement payload (bytes)
+            - dict of decoded values
+        """
+
+        self._seen[address] = (bytes(payload), time.monotonic(), dict(values))
+
+
+    def forget(self, address=None):
+        """
+        Drop the remembered payload for one address, or for all of them
+        """
+
+        if address is None:
+            self._seen.clear()
+        else:
+            self._seen.pop(address, None)
@@ -0,0 +1,139 @@
+"""
+Batch decoders for buffered BLE advertisements.
+
+Live scanning decodes one advertisement at a time, in each plugin's
+read_advertisement. For backfill, replay and high-rate gateways these
+functions decode many raw payloads at once, with NumPy masking and
+arithmetic, into columnar arrays. Range validation is applied as a vector
+mask, in the 'valid' column.
+
+NumPy is only needed for these batch decoders. Plugins still load (and
+decode live advertisements) without it.
+"""
+
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("Batch decoding requires the numpy package")
+
+
+def _rows(payloads, width):
+    """
+    Pack payloads into an (n, width) uint8 array. Short payloads are zero
+    padded, and flagged False in the returned length mask.
+    """
+
+    n = len(payloads)
+    lengths = np.fromiter((len(p) for p in payloads), dtype=np.int64, count=n)
+    packed = b''.join(bytes(p[:width]).ljust(width, b'\x00') for p in payloads)
+    buf = np.frombuffer(packed, dtype=np.uint8).reshape(n, width)
+    return buf, lengths >= width
+
+
+def _in_range(values, limits):
+    low, high = limits
+    return (values >= low) & (values <= high)
+
+
+def decode_switchbot(payloads, limits:dict):
+    """
+    Decode SwitchBot hygrometer service data payloads
+    args:
+        - list of raw service data payloads (bytes)
+        - dict of {field: (min, max)} validation ranges
+    returns:
+        dict of numpy arrays, with keys
+        temperature, humidity, battery and valid
+    """
+
+    _require_numpy()
+    buf, valid = _rows(payloads, 6)
+
+    battery = (buf[:, 2] & 0b01111111).astype(np.int64)
+    humidity = (buf[:, 5] & 0b01111111).astype(np.int64)
+    temperature = (buf[:, 3] & 0b00001111) / 10 + (buf[:, 4] & 0b01111111)
+    above_zero = (buf[:, 4] & 0b10000000).astype(bool)
+    temperature = np.where(above_zero, temperature, -temperature)
+
+    columns = {
+        'temperature': temperature,
+        'humidity': humidity,
+        'battery': battery }
+
+    for key, values in columns.items():
+        valid &= _in_range(values, limits[key])
+
+    columns['valid'] = valid
+    return columns
+
+
+def decode_govee_outlets(payloads, dual=None):
+    """
+    Decode Govee outlet manufacturer data payloads. The outlet state is in
+    the final byte of the payload.
+    args:
+        - list of raw manufacturer data payloads (bytes)
+        - list of bools, True where the payload is from a dual outlet H5082
+          (optional. if None, all payloads are single outlet)
+    returns:
+        dict of numpy arrays, with keys outlet_1, outlet_2 and valid.
+        outlet_2 is -1 for single outlet payloads.
+    """
+
+    _require_numpy()
+    n = len(payloads)
+    valid = np.fromiter((len(p) > 0 for p in payloads), dtype=bool, count=n)
+    value = np.fromiter((p[-1] if len(p) else 0 for p in payloads),
+        dtype=np.int64, count=n)
+
+    if dual is None:
+        dual = np.zeros(n, dtype=bool)
+    else:
+        dual = np.asarray(dual, dtype=bool)
+
+    outlet_1 = np.where(dual, (value >> 1) & 1, value)
+    outlet_2 = np.where(dual, value & 1, -1)
+
+    return {
+        'outlet_1': outlet_1,
+        'outlet_2': outlet_2,
+        'valid': valid }
+
+
+def to_records(columns:dict, types:dict):
+    """
+    Convert decoded columns back to a list of per-payload result dicts, the
+    same as read_advertisement would return. Invalid rows are None.
+    args:
+        - dict of numpy arrays, from one of the decode functions
+        - dict of {field: python type} to convert each column to
+    returns:
+        list
+    """
+
+    results = []
+    names = [k for k in types if k in columns]
+    values = [columns[k].tolist() for k in names]
+    for i, ok in enumerate(columns['valid'].tolist()):
+        if not ok:
+            results.append(None)
+            continue
+
+        row = {}
+        for key, column in zip(names, values):
+            if column[i] == -1 and key.startswith('outlet'):
+                continue
+            row[key] = types[key](column[i])
+        results.append(row)
+
+    return results
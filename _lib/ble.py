@@ -0,0 +1,387 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextlib
+from bleak import BleakClient
+
+
+logger = logging.getLogger(__name__)
+
+
+def record(stats, key, name, value):
+    """
+    Record a timing or count in a stats dict, like
+    stats[key] = {name: latest, name_total: sum, name_count: n}
+    args:
+        - stats dict
+        - key, usually a device address
+        - stat name
+        - value
+    returns:
+        none
+    """
+
+    s = stats.setdefault(key, {})
+    s[name] = value
+    s[name + '_total'] = s.get(name + '_total', 0) + value
+    s[name + '_count'] = s.get(name + '_count', 0) + 1
+
+
+class Slot:
+    """
+    A connection slot on a bluetooth adapter, granted by the scheduler.
+    Releasing a slot more than once has no effect.
+    """
+
+    def __init__(self, scheduler, adapter, address):
+        self.adapter = adapter
+        self.address = address
+        self._scheduler = scheduler
+        self._released = False
+
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self.adapter)
+
+
+class ConnectionScheduler:
+    """
+    Share the limited connection slots of each bluetooth adapter between
+    all plugins.
+
+    Every plugin connection goes through here. At most max_connections
+    clients are connected per adapter, the rest wait in a queue. Waiters
+    are served by priority (lower number first), then first come first
+    served. Queue wait and connect time are recorded for each device.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_connections = 3
+        self.priorities = {}
+        self.stats = {}
+        for k, v in kwargs.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+
+        self._adapters = {}
+        self._sequence = itertools.count()
+
+
+    async def acquire(self, address, priority=10, adapter=None):
+        """
+        Wait for a free connection slot
+        args:
+            - device address
+            - priority (lower number is served first). A per-device entry
+              in self.priorities overrides this.
+            - adapter name, like 'hci0' (optional)
+        returns:
+            Slot
+        """
+
+        priority = self.priorities.get(address, priority)
+        state = self._adapter(adapter)
+        started = time.monotonic()
+
+        if state['active'] < self.max_connections and not state['waiting']:
+            state['active'] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(state['waiting'],
+                (priority, next(self._sequence), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # slot was granted as we were cancelled. hand it on.
+                    self._release(adapter)
+                else:
+                    future.cancel()
+                raise
+
+        record(self.stats, address, 'queue_wait', time.monotonic() - started)
+        return Slot(self, adapter, address)
+
+
+    async def open(self, client, priority=10, adapter=None):
+        """
+        Acquire a slot and connect a client. If the connection fails, the
+        slot is released and the error raised.
+        args:
+            - BleakClient
+            - priority (lower number is served first)
+            - adapter name (optional)
+        returns:
+            Slot
+        """
+
+        address = client.address
+        slot = await self.acquire(address, priority, adapter)
+        started = time.monotonic()
+        try:
+            await client.connect()
+        except BaseException:
+            record(self.stats, address, 'failures', 1)
+            slot.release()
+            raise
+
+        record(self.stats, address, 'connect_time', time.monotonic() - started)
+        logger.debug("Connected %s. queue wait %0.3fs, connect %0.3fs" % (
+            address,
+            self.stats[address]['queue_wait'],
+            self.stats[address]['connect_time']))
+        return slot
+
+
+    @contextlib.asynccontextmanager
+    async def connect(self, address, priority=10, adapter=None):
+        """
+        Connect to a device, for use as
+            async with scheduler.connect(address) as client:
+                ...
+        args:
+            - device address
+            - priority (lower number is served first)
+            - adapter name (optional)
+        returns:
+            connected BleakClient
+        """
+
+        if adapter is None:
+            client = BleakClient(address)
+        else:
+            client = BleakClient(address, adapter=adapter)
+
+        slot = await self.open(client, priority, adapter)
+        try:
+            yield client
+        finally:
+            try:
+                await client.disconnect()
+            except Exception as x:
+                logger.debug(x)
+            slot.release()
+
+
+    def waiting(self, adapter=None):
+        """
+        Get the number of connections queued for an adapter
+        """
+
+        return len([w for w in self._adapter(adapter)['waiting']
+            if not w[2].done()])
+
+
+    def _adapter(self, adapter):
+        if adapter not in self._adapters:
+            self._adapters[adapter] = {'active': 0, 'waiting': []}
+
+        return self._adapters[adapter]
+
+
+    def _release(self, adapter):
+        """
+        Free a slot, and hand it straight to the next waiter if any
+        """
+
+        state = self._adapter(adapter)
+        while state['waiting']:
+            priority, seq, future = heapq.heappop(state['waiting'])
+            if not future.done():
+                future.set_result(True)
+                return
+
+        state['active'] = max(0, state['active'] - 1)
+
+
+class ConnectionPool:
+    """
+    Keep device clients connected between commands.
+
+    Clients are pooled by address. get() hands out a connected client,
+    reconnecting transparently if the link dropped. release() hands it
+    back, and it is disconnected after idle_timeout seconds unused.
+
+    Pooled clients hold a scheduler slot while connected, so at most
+    max_size are kept open. This leaves adapter slots free for sensor
+    polling. When the pool is full, the least recently used idle client is
+    closed. If none are idle, the new client is used for one command only.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.idle_timeout = 60
+        self.max_size = 2
+        self.scheduler = None
+        for k, v in kwargs.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+
+        self._entries = {}
+
+
+    async def get(self, address, priority=10):
+        """
+        Get a connected client
+        args:
+            - device address
+            - scheduler priority, if a new connection is needed
+        returns:
+            BleakClient
+        """
+
+        entry = self._entries.get(address)
+        if entry is None:
+            pooled = await self._make_room()
+            entry = self._entries.get(address)
+
+        if entry is None:
+            entry = {
+                'client': BleakClient(address,
+                    disconnected_callback=self._disconnected),
+                'lock': asyncio.Lock(),
+                'slot': None,
+                'users': 0,
+                'used': 0,
+                'timer': None,
+                'pooled': pooled }
+            self._entries[address] = entry
+
+        if entry['timer'] is not None:
+            entry['timer'].cancel()
+            entry['timer'] = None
+
+        entry['users'] += 1
+        try:
+            async with entry['lock']:
+                if entry['slot'] is None or not entry['client'].is_connected:
+                    if entry['slot'] is not None:
+                        entry['slot'].release()
+                        entry['slot'] = None
+                    entry['slot'] = await self._scheduler().open(
+                        entry['client'], priority)
+        except BaseException:
+            await self.release(address)
+            raise
+
+        return entry['client']
+
+
+    def slot(self, address):
+        """
+        Get the scheduler slot of a pooled client. A new slot is taken each
+        time the client (re)connects, so it identifies the connection
+        session.
+        returns:
+            Slot, or None if not connected
+        """
+
+        entry = self._entries.get(address)
+        if entry is None:
+            return None
+
+        return entry['slot']
+
+
+    async def release(self, address):
+        """
+        Hand a client back to the pool. It is closed once idle too long,
+        or right away if it could not be pooled.
+        """
+
+        entry = self._entries.get(address)
+        if entry is None:
+            return
+
+        entry['users'] = max(0, entry['users'] - 1)
+        entry['used'] = time.monotonic()
+        if entry['users']:
+            return
+
+        if not entry['pooled'] or entry['slot'] is None:
+            await self.close(address)
+        else:
+            loop = asyncio.get_running_loop()
+            entry['timer'] = loop.call_later(self.idle_timeout,
+                lambda: asyncio.ensure_future(self._close_idle(address)))
+
+
+    async def close(self, address=None):
+        """
+        Disconnect and forget one client, or all of them
+        """
+
+        if address is None:
+            for a in list(self._entries):
+                await self.close(a)
+            return
+
+        entry = self._entries.pop(address, None)
+        if entry is None:
+            return
+
+        if entry['timer'] is not None:
+            entry['timer'].cancel()
+
+        try:
+            await entry['client'].disconnect()
+        except Exception as x:
+            logger.debug(x)
+
+        if entry['slot'] is not None:
+            entry['slot'].release()
+            entry['slot'] = None
+
+
+    async def _close_idle(self, address):
+        entry = self._entries.get(address)
+        if entry is not None and not entry['users']:
+            logger.debug("Closing idle connection to %s" % address)
+            await self.close(address)
+
+
+    async def _make_room(self):
+        """
+        Close the least recently used idle client, if the pool is full.
+        returns:
+            Boolean (True if there is room for another pooled client)
+        """
+
+        pooled = [(e['used'], a) for a, e in self._entries.items()
+            if e['pooled']]
+        if len(pooled) < self.max_size:
+            return True
+
+        for used, address in sorted(pooled):
+            if not self._entries[address]['users']:
+                await self.close(address)
+                return True
+
+        return False
+
+
+    def _disconnected(self, client):
+        """
+        Link dropped. Free the adapter slot now, reconnect on next use.
+        """
+
+        entry = self._entries.get(client.address)
+        if entry is not None and entry['client'] is client:
+            if entry['slot'] is not None:
+                entry['slot'].release()
+                entry['slot'] = None
+
+
+    def _scheduler(self):
+        if self.scheduler is not None:
+            return self.scheduler
+
+        return scheduler
+
+
+# shared scheduler and connection pool, for all plugins
+scheduler = ConnectionScheduler()
+pool = ConnectionPool()
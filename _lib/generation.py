@@ -0,0 +1,43 @@
+"""
+Change counters shared by every copy of a plugin.
+
+potnanny runs the plugin files again each time it loads plugins (at every
+worker restart), which makes new plugin classes, while hooks installed by an
+earlier load stay bound to the old ones. Modules in _lib are imported once,
+so a counter kept here is seen by all of them. A writer bumps the counter
+when it changes something; a reader keeps the count its cache was built at,
+and rebuilds when the two differ.
+
+    from _lib import generation
+
+    generation.bump('controls')
+    if cls._generation != generation.get('controls'):
+        rebuild()
+"""
+
+_counts = {}
+
+
+def bump(name):
+    """
+    Mark the named data as changed
+    args:
+        - name
+    returns:
+        the new count
+    """
+
+    _counts[name] = _counts.get(name, 0) + 1
+    return _counts[name]
+
+
+def get(name):
+    """
+    Get the current count of the named data
+    args:
+        - name
+    returns:
+        int
+    """
+
+    return _counts.get(name, 0)
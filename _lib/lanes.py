@@ -0,0 +1,70 @@
+"""
+Pipeline plugins served by fan-out lanes.
+
+A FanoutPipeline lane hands measurements to its plugins itself, through the
+lane queue. Those plugins stay in potnanny's plugin list (the api lists
+plugins from it), so they must ignore the batches the pipeline hands them
+directly. A pipeline plugin that can be put in a lane checks owned() first:
+
+    async def input(self, measurements):
+        if lanes.owned(self):
+            return
+
+Lane plugins are found by class name, from the lanes setting of the newest
+FanoutPipeline class, so this holds from the first batch on, and after
+potnanny loads the plugins again (which registers new classes).
+"""
+
+from potnanny.plugins import PipelinePlugin
+
+
+def fanout():
+    """
+    Get the FanoutPipeline class that runs the lanes
+    returns:
+        the last FanoutPipeline class registered, or None
+    """
+
+    for p in reversed(PipelinePlugin.plugins):
+        if p.__name__ == 'FanoutPipeline':
+            return p
+
+    return None
+
+
+def owned(plugin):
+    """
+    Is a plugin instance served by a fan-out lane, instead of the pipeline?
+    args:
+        - pipeline plugin instance
+    returns:
+        Boolean (False for an instance created by the lane itself)
+    """
+
+    if getattr(plugin, '_lane', False):
+        return False
+
+    f = fanout()
+    if f is None:
+        return False
+
+    name = type(plugin).__name__
+    for lane in f.lanes:
+        if name in lane.get('plugins', ()):
+            return True
+
+    return False
+
+
+def deliver(plugin):
+    """
+    Create a plugin instance for a lane to deliver to
+    args:
+        - pipeline plugin class
+    returns:
+        instance, that owned() does not turn away
+    """
+
+    instance = plugin()
+    instance._lane = True
+    return instance
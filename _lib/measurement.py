@@ -0,0 +1,317 @@
+"""
+Compact measurement records, and a fast validator for pipeline input.
+
+The pipeline hands plugins a list of measurement dicts. Validating them
+with potnanny's marshmallow MeasurementSchema builds a schema object and
+walks every field of every dict through marshmallow's machinery, which
+dominates pipeline CPU time on small gateways. validate() applies the same
+rules with plain python, and returns Record tuples:
+
+    Record(device_id, type, value, created)
+
+Records are tuples, so they are small, cheap to create, and can be passed
+straight to Measurement.insert_many() with the FIELDS column order.
+
+A MeasurementBatch holds a whole batch as parallel columns instead: arrays
+of device ids, type codes and values, and a list of created times. Type
+strings are interned to small integer codes (type_code, type_name), so
+routing a batch compares integers, not strings. Plugins that consume
+batches set columnar = True; adapt() hands every other plugin the usual
+list of dicts.
+"""
+
+import re
+import math
+import logging
+import datetime
+from array import array
+from typing import NamedTuple
+from markupsafe import escape
+
+
+logger = logging.getLogger(__name__)
+
+# column order of a Record, for insert_many(rows, fields=...)
+FIELDS = ('device_id', 'type', 'value', 'created')
+_FIELD_SET = frozenset(FIELDS)
+
+
+class Record(NamedTuple):
+    device_id: int
+    type: str
+    value: float
+    created: datetime.datetime
+
+    def as_dict(self):
+        return {
+            'device_id': self.device_id,
+            'type': self.type,
+            'value': self.value,
+            'created': self.created,
+        }
+
+
+# measurement type strings, as given -> as cleaned. there are only a few
+# dozen types, so cleaning each one once is enough.
+_types = {}
+_MAX_TYPES = 1024
+_plain = re.compile(r'[^<>&\'"]*\Z').match
+
+
+def _clean_type(kind):
+    """
+    Clean a type string like SafeSchema does (markupsafe escaped, stripped)
+    """
+
+    if isinstance(kind, bytes):
+        kind = kind.decode()
+    elif not isinstance(kind, str):
+        raise ValueError("type must be a string")
+
+    if _plain(kind):
+        clean = kind.strip()
+    else:
+        clean = str(escape(kind)).strip()
+
+    if len(_types) >= _MAX_TYPES:
+        _types.clear()
+    _types[kind] = clean
+    return clean
+
+
+def _number(value, coerce):
+    if value is True or value is False or value is None:
+        raise ValueError("not a number: %r" % (value,))
+    return coerce(value)
+
+
+def _now():
+    # same as the Measurement.created default
+    return datetime.datetime.utcnow().replace(second=0, microsecond=0)
+
+
+def validate(measurements, sanitize=True, extra=None):
+    """
+    Validate measurement dicts, and convert them to Records. Records in the
+    input are passed through, and a MeasurementBatch (already validated) is
+    converted. Invalid measurements are left out (and logged), instead of
+    failing the whole batch.
+    args:
+        - list of measurement dicts (or Records), or a MeasurementBatch
+        - escape type strings? (False if SafeSchema already did)
+        - list, to append the other keys of each measurement to (optional)
+    returns:
+        list of Records
+    """
+
+    if isinstance(measurements, MeasurementBatch):
+        if extra is not None:
+            extra += measurements.extra or [None] * len(measurements)
+        return measurements.records()
+
+    records = []
+    append = records.append
+    types = _types
+    isfinite = math.isfinite
+    now = None
+    for m in measurements:
+        if type(m) is Record:
+            append(m)
+            if extra is not None:
+                extra.append(None)
+            continue
+
+        try:
+            device_id = m['device_id']
+            if type(device_id) is not int:
+                device_id = _number(device_id, int)
+
+            value = m['value']
+            if type(value) is not float:
+                value = _number(value, float)
+            if not isfinite(value):
+                raise ValueError("not a finite number: %r" % value)
+
+            kind = m['type']
+            if not sanitize:
+                clean = kind
+            elif type(kind) is str:
+                clean = types.get(kind)
+            else:
+                clean = None
+            if clean is None:
+                clean = _clean_type(kind)
+
+            created = m.get('created')
+            if created is None:
+                if now is None:
+                    now = _now()
+                created = now
+        except Exception as x:
+            logger.debug("Invalid measurement %s: %s" % (m, x))
+            continue
+
+        append(Record(device_id, clean, value, created))
+        if extra is not None:
+            extra.append({k: v for k, v in m.items()
+                if k not in _FIELD_SET} or None)
+
+    return records
+
+
+# interned measurement types. codes are never reused, and stay valid for
+# the life of the process.
+_codes = {}
+_names = []
+
+
+def type_code(name):
+    """
+    Get the integer code of a measurement type
+    """
+
+    code = _codes.get(name)
+    if code is None:
+        code = _codes[name] = len(_names)
+        _names.append(name)
+    return code
+
+
+def type_name(code):
+    """
+    Get the measurement type of an integer code
+    """
+
+    return _names[code]
+
+
+class MeasurementBatch:
+    """
+    Columnar batch of valid measurements
+    """
+
+    __slots__ = ('device_ids', 'types', 'values', 'created', 'extra')
+
+    def __init__(self, *args, **kwargs):
+        self.device_ids = array('q')
+        self.types = array('H')
+        self.values = array('d')
+        self.created = []
+
+        # None, or a list holding a dict of other keys (like device_name)
+        # or None for each measurement
+        self.extra = None
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def append(self, device_id, kind, value, created, extra=None):
+        """
+        Add one measurement. No validation is done.
+        """
+
+        if extra is not None and self.extra is None:
+            self.extra = [None] * len(self)
+
+        self.device_ids.append(device_id)
+        self.types.append(type_code(kind))
+        self.values.append(value)
+        self.created.append(created)
+        if self.extra is not None:
+            self.extra.append(extra)
+
+
+    @classmethod
+    def from_dicts(cls, measurements, sanitize=True):
+        """
+        Validate measurement dicts into a batch. Invalid measurements are
+        left out.
+        args:
+            - list of measurement dicts (or Records)
+            - escape type strings?
+        returns:
+            MeasurementBatch
+        """
+
+        extra = []
+        batch = cls.from_records(validate(measurements, sanitize, extra))
+        if any(e is not None for e in extra):
+            batch.extra = extra
+        return batch
+
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Make a batch of Records
+        args:
+            - list of Records
+        returns:
+            MeasurementBatch
+        """
+
+        batch = cls()
+        if not records:
+            return batch
+
+        device_ids, kinds, values, created = zip(*records)
+        codes = _codes
+        batch.device_ids = array('q', device_ids)
+        batch.types = array('H', [codes[k] if k in codes else type_code(k)
+            for k in kinds])
+        batch.values = array('d', values)
+        batch.created = list(created)
+        return batch
+
+
+    def records(self):
+        """
+        Get the batch as a list of Records
+        """
+
+        names = _names
+        return list(map(Record, self.device_ids,
+            [names[c] for c in self.types], self.values, self.created))
+
+
+    def as_dict(self, i):
+        """
+        Get one measurement of the batch as a dict
+        """
+
+        m = {
+            'device_id': self.device_ids[i],
+            'type': _names[self.types[i]],
+            'value': self.values[i],
+            'created': self.created[i] }
+        if self.extra is not None and self.extra[i]:
+            m.update(self.extra[i])
+        return m
+
+
+    def to_dicts(self):
+        """
+        Get the batch as a list of measurement dicts, for plugins that do
+        not take batches
+        """
+
+        return [self.as_dict(i) for i in range(len(self))]
+
+
+def adapt(measurements, plugin):
+    """
+    Get measurements in the form a pipeline plugin takes
+    args:
+        - list of measurement dicts, or a MeasurementBatch
+        - pipeline plugin class or instance
+    returns:
+        a MeasurementBatch is converted to a list of measurement dicts,
+        unless the plugin is columnar. lists are returned as they are.
+    """
+
+    if (isinstance(measurements, MeasurementBatch) and
+        not getattr(plugin, 'columnar', False)):
+        return measurements.to_dicts()
+    return measurements
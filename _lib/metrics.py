@@ -0,0 +1,408 @@
+"""
+In-process counters, gauges and histograms, with Prometheus text exposition.
+
+Metrics are off by default, and then cost one attribute check per call.
+Turn them on with metrics.configure(enabled=True), or by setting one of
+these environment variables before potnanny starts:
+
+    POTNANNY_METRICS_FILE   write the metrics to this file (for the
+                            node_exporter textfile collector)
+    POTNANNY_METRICS_PORT   serve the metrics over http, on this port
+                            (localhost only, any path)
+
+Either one enables metrics. The exporter starts with the first metric
+recorded, since that is when an event loop is known to be running.
+"""
+
+import os
+import time
+import bisect
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# seconds. from 100us to 10s, for pipeline and database work
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# counts, for batch sizes and fan-out
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class _Null:
+    """
+    Do nothing timer, handed out when metrics are disabled
+    """
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        pass
+
+
+_null = _Null()
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started,
+            **self.labels)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("Metric %s takes labels %s" % (
+                self.name, self.labels))
+        return tuple(labels[k] for k in self.labels)
+
+
+    def clear(self):
+        self._values = {}
+
+
+    def expose(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.kind) ]
+        lines += self._samples()
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        """
+        Add to the counter, if metrics are enabled
+        """
+
+        if not self.registry.enabled:
+            return
+
+        self.registry.start()
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+    def _samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, k),
+            _format_value(v)) for k, v in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """
+        Set the gauge, if metrics are enabled
+        """
+
+        if not self.registry.enabled:
+            return
+
+        self.registry.start()
+        self._values[self._key(labels)] = value
+
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+    def _samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, k),
+            _format_value(v)) for k, v in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value, **labels):
+        """
+        Record a value, if metrics are enabled
+        """
+
+        if not self.registry.enabled:
+            return
+
+        self.registry.start()
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [bucket counts..., +Inf count], sum
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+
+    def time(self, **labels):
+        """
+        Time a block, like
+            with histogram.time():
+                ...
+        """
+
+        if not self.registry.enabled:
+            return _null
+
+        return _Timer(self, labels)
+
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        if state is None:
+            return 0
+        return sum(state[0])
+
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (self.name,
+                    _format_labels(self.labels, key,
+                        ('le', _format_value(float(bound)))),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (self.name,
+                _format_labels(self.labels, key), _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name,
+                _format_labels(self.labels, key), cumulative))
+        return lines
+
+
+class Registry:
+    """
+    A set of metrics, and their exporter
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.enabled = False
+        self.path = None
+        self.port = None
+        self.interval = 15
+        self.configure(**kwargs)
+
+        self._metrics = {}
+        self._exporter = None
+        self._server = None
+
+
+    def configure(self, **kwargs):
+        """
+        Change settings
+        args:
+            - enabled (bool)
+            - path, to write the metrics to (optional)
+            - port, to serve the metrics on (optional)
+            - interval, seconds between writes to path
+        """
+
+        for k, v in kwargs.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self, name, help, labels))
+
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(self, name, help, labels))
+
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError("Metric %s already registered as a %s" % (
+                    metric.name, existing.kind))
+            # plugin modules may be loaded more than once
+            return existing
+
+        self._metrics[metric.name] = metric
+        return metric
+
+
+    def clear(self):
+        for m in self._metrics.values():
+            m.clear()
+
+
+    def expose(self):
+        """
+        Get all metrics in Prometheus text exposition format
+        returns:
+            str
+        """
+
+        lines = []
+        for name in sorted(self._metrics):
+            lines += self._metrics[name].expose()
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path=None):
+        """
+        Write the metrics to a file. The file is replaced in one step, so
+        readers never see a partial file.
+        """
+
+        path = path or self.path
+        partial = '%s.%d.tmp' % (path, os.getpid())
+        with open(partial, 'w') as fh:
+            fh.write(self.expose())
+        os.replace(partial, path)
+
+
+    def start(self):
+        """
+        Start the exporter, if one is configured and not already running
+        """
+
+        if self._exporter is not None or (not self.path and not self.port):
+            return
+
+        try:
+            self._exporter = asyncio.get_running_loop().create_task(
+                self._export())
+        except RuntimeError:
+            # no event loop yet. try again on the next metric.
+            pass
+
+
+    async def _export(self):
+        if self.port:
+            try:
+                self._server = await asyncio.start_server(self._handle,
+                    '127.0.0.1', int(self.port))
+            except Exception as x:
+                logger.warning("Metrics server failed to start: %s" % x)
+
+        while self.path:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except Exception as x:
+                logger.warning("Metrics write to %s failed: %s" % (
+                    self.path, x))
+
+
+    async def _handle(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.expose().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4\r\n'
+                b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except Exception as x:
+            logger.debug(x)
+        finally:
+            writer.close()
+
+
+    async def stop(self):
+        """
+        Stop the exporter. The metrics file is written one last time.
+        """
+
+        if self._exporter is not None:
+            self._exporter.cancel()
+            self._exporter = None
+
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        if self.path:
+            self.write()
+
+
+def _from_environment():
+    path = os.environ.get('POTNANNY_METRICS_FILE') or None
+    port = os.environ.get('POTNANNY_METRICS_PORT') or None
+    return {
+        'enabled': bool(path or port),
+        'path': path,
+        'port': port }
+
+
+# shared registry, for all plugins
+metrics = Registry(**_from_environment())
+
+# measurement counts and timing of pipeline plugins, labelled with the
+# plugin class name. shared, so each is registered once.
+batch_size = metrics.histogram('potnanny_pipeline_batch_size',
+    "Measurements per pipeline input batch", ['plugin'], SIZE_BUCKETS)
+input_seconds = metrics.histogram('potnanny_pipeline_input_seconds',
+    "Time spent in pipeline input", ['plugin'])
+measurements_in = metrics.counter('potnanny_pipeline_measurements_in_total',
+    "Measurements received by pipeline plugins", ['plugin'])
+measurements_out = metrics.counter('potnanny_pipeline_measurements_out_total',
+    "Measurements passed on by pipeline plugins", ['plugin'])
+measurements_rejected = metrics.counter(
+    'potnanny_pipeline_measurements_rejected_total',
+    "Invalid measurements left out by pipeline plugins", ['plugin'])
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationWaiter:
+    """
+    Wait for a matching notification from a BLE characteristic.
+
+    Subscribes to the characteristic on enter, and unsubscribes on exit.
+    wait() returns the moment a notification passes the match function,
+    instead of sleeping and polling for it. All waits share one overall
+    deadline.
+
+        async with NotificationWaiter(client, uuid, match, deadline=5) as w:
+            await client.write_gatt_char(tx, payload)
+            data = await w.wait(1)
+    """
+
+    def __init__(self, client, uuid, match=None, deadline=None):
+        self.client = client
+        self.uuid = uuid
+        self.match = match
+        self.deadline = deadline
+        self._future = None
+        self._expires = None
+
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        self._future = loop.create_future()
+        if self.deadline is not None:
+            self._expires = loop.time() + self.deadline
+
+        await self.client.start_notify(self.uuid, self._callback)
+        return self
+
+
+    async def __aexit__(self, *args):
+        try:
+            await self.client.stop_notify(self.uuid)
+        except Exception as x:
+            logger.debug("Error stopping notifications: %s" % x)
+
+
+    def _callback(self, sender, data):
+        if self._future.done():
+            return
+
+        try:
+            if self.match is None or self.match(data):
+                self._future.set_result(data)
+        except Exception as x:
+            logger.debug(x)
+
+
+    async def wait(self, timeout=None):
+        """
+        Wait for a matching notification
+        args:
+            - max seconds to wait (optional. limited by the overall deadline)
+        returns:
+            notification data, or None if nothing matched in time
+        """
+
+        if self._expires is not None:
+            remaining = self._expires - asyncio.get_running_loop().time()
+            if timeout is None or remaining < timeout:
+                timeout = max(0, remaining)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            return None
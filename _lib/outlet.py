@@ -0,0 +1,579 @@
+import time
+import asyncio
+import logging
+from bleak import BleakClient
+from _lib.ble import pool, record, scheduler
+from _lib.notify import NotificationWaiter
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutletCommands:
+    """
+    Per-device command queues for switchable outlets.
+
+    Commands to one device are applied one batch at a time, so overlapping
+    on()/off() calls never fight over the same connection. While a batch
+    is being applied, new commands wait, and are coalesced with last write
+    wins per outlet. The next batch carries the pending state of every
+    outlet, so a dual outlet device can set both in one session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._devices = {}
+
+
+    async def submit(self, address, outlet, value, apply):
+        """
+        Queue a command, and wait for the batch it ends up in
+        args:
+            - device address
+            - outlet number
+            - state to set the outlet to
+            - async function to apply a batch, taking a dict of
+              {outlet: value} and returning {outlet: result}
+        returns:
+            result for the outlet. If the command was superseded by a later
+            one, this is the result of the later command.
+        """
+
+        state = self._device(address)
+        future = asyncio.get_running_loop().create_future()
+        pending = state['pending'].get(outlet)
+        if pending is not None:
+            logger.debug("Coalescing outlet %s command on %s" % (
+                outlet, address))
+            futures = pending[1]
+        else:
+            futures = []
+
+        futures.append(future)
+        state['pending'][outlet] = (value, futures)
+        state['apply'] = apply
+        if state['task'] is None or state['task'].done():
+            state['task'] = asyncio.create_task(self._run(address))
+
+        return await future
+
+
+    def pending(self, address):
+        """
+        Get the commands waiting for a device, or being applied to it now
+        returns:
+            dict of {outlet: value}
+        """
+
+        state = self._device(address)
+        results = dict(state['running'])
+        results.update({k: v[0] for k, v in state['pending'].items()})
+        return results
+
+
+    def _device(self, address):
+        if address not in self._devices:
+            self._devices[address] = {
+                'pending': {},
+                'running': {},
+                'apply': None,
+                'task': None }
+
+        return self._devices[address]
+
+
+    async def _run(self, address):
+        """
+        Apply pending batches for a device, until none are left
+        """
+
+        state = self._devices[address]
+        try:
+            while state['pending']:
+                batch = state['pending']
+                state['pending'] = {}
+                state['running'] = {k: v[0] for k, v in batch.items()}
+                try:
+                    results = await state['apply'](dict(state['running']))
+                except Exception as x:
+                    for value, futures in batch.values():
+                        for f in futures:
+                            if not f.done():
+                                f.set_exception(x)
+                    continue
+
+                for outlet, (value, futures) in batch.items():
+                    for f in futures:
+                        if not f.done():
+                            f.set_result(results.get(outlet, -1))
+        finally:
+            state['running'] = {}
+
+
+class OutletStates:
+    """
+    Latest known state of each device outlet.
+
+    Fed by device advertisements and confirmed commands, so a command path
+    can skip connecting to a device that is already in the requested state.
+    Addresses are matched case-insensitively.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._states = {}
+
+
+    def update(self, address, outlet, value):
+        """
+        Record the state of an outlet, as of now
+        """
+
+        self._states.setdefault(address.upper(), {})[outlet] = (value, time.monotonic())
+
+
+    def get(self, address, outlet, max_age):
+        """
+        Get the state of an outlet, if it is fresh enough
+        args:
+            - device address
+            - outlet number
+            - max age of the state, in seconds
+        returns:
+            state, or None if not known or too old
+        """
+
+        known = self._states.get(address.upper(), {}).get(outlet)
+        if known is None or time.monotonic() - known[1] > max_age:
+            return None
+
+        return known[0]
+
+
+    def forget(self, address, outlet):
+        self._states.get(address.upper(), {}).pop(outlet, None)
+
+
+class PacketManager:
+    """
+    Class for manipulating and validating data packets from BLE device
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.default_sz = 20
+        for k, v in kwargs.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+
+
+    def validate(self, data, size=None, contains_chksum=True):
+        """
+        Validate a byte array. Ensure proper length and chksum. The data is
+        checked in place, without slicing a copy of it.
+        args:
+            - bytearray (or other bytes-like object)
+            - expected size of data, including chksum (optional)
+            - is final byte of the array an XOR chksum to be validated?
+        returns:
+            - Bool
+        """
+
+        if size is None:
+            size = self.default_sz
+
+        if not isinstance(data, (bytearray, bytes, memoryview)):
+            logger.warning("Data is not bytes-like (%s) %s" % (type(data), data))
+            return False
+
+        if len(data) != size:
+            logger.warning("Data incorrect length (%d) %s" % (len(data), data))
+            return False
+
+        if contains_chksum:
+            # XOR of the data bytes equals the final chksum byte, so the XOR
+            # of the whole packet is zero
+            chksum = 0
+            for val in data:
+                chksum ^= val
+
+            if chksum:
+                logger.warning("Data checksum wrong (%d) %s" % (
+                    chksum ^ data[-1], data))
+                return False
+
+        return True
+
+
+    def get_checksum(self, data):
+        """
+        Do an XOR of all bytes to get a checksum of the data
+        args:
+            bytes-like
+        returns:
+            int
+        """
+
+        chksum = 0
+        for val in data:
+            chksum ^= val
+
+        return chksum
+
+
+    def build(self, data, size=None, add_chksum=True):
+        """
+        Build a bytearray of the proper length. Zeros are padded to the end.
+        args:
+            - bytearray
+            - size of final packet buffer (int)
+            - Final byte should be checksum of previous bytes?
+        returns:
+            bytearray
+        """
+
+        if size is None:
+            size = self.default_sz
+
+        if len(data) < size:
+            data += bytes(size - len(data))
+
+        if add_chksum:
+            data[-1] = self.get_checksum(memoryview(data)[:(size - 1)])
+
+        return data
+
+
+    def template(self, data, size=None):
+        """
+        Build a complete, checksummed packet once, for a fixed command
+        args:
+            - bytes
+            - size of final packet (int)
+        returns:
+            bytes (immutable)
+        """
+
+        return bytes(self.build(bytearray(data), size))
+
+
+class GoveeOutlet:
+    """
+    Connection, authorization and switching code shared by the Govee
+    bluetooth outlet plugins. A plugin class mixes this in ahead of
+    BluetoothDevicePlugin, and sets:
+
+        code = packet table of the model, with STATE, HAS_SECRET, send_key,
+               WAIT_SECRET_PACKET and SWITCH_PACKETS, a dict of complete
+               switch packets keyed by (outlet, state)
+        confirm_wait = seconds to wait for a switch to be confirmed
+        stats, _authenticated = dicts, per plugin class
+
+    and decodes its advertised outlet states in decode_state().
+    """
+
+    code = None
+    confirm_wait = 0.3
+
+    # seconds before an unchanged advertisement is decoded again
+    heartbeat = 60
+
+    # connection priority, lower numbers are served first
+    priority = 0
+
+    # keep the connection open between commands (see _lib.ble.ConnectionPool)
+    pooled = True
+
+    # skip switching an outlet that advertised the requested state within
+    # this many seconds. 0 to always switch.
+    freshness = 30
+
+    def __init__(self, *args, **kwargs):
+        self.address = None
+        self.key_code = None
+        self._state = None
+        self._auto_disconnect = True
+        self._default_packet_sz = 20
+        self._tx = '00010203-0405-0607-0809-0a0b0c0d2b11'
+        self._rx = '00010203-0405-0607-0809-0a0b0c0d2b10'
+        self._client = None
+        self._slot = None
+        self._packet = PacketManager(default_sz=20)
+
+        allowed = ['address', 'key_code']
+        for k, v in kwargs.items():
+            if hasattr(self, k) and k in allowed:
+                setattr(self, k, v)
+
+        if self.address is None:
+            raise ValueError("Need a device address")
+
+
+    async def connect(self):
+        """
+        Connect client to device
+        """
+
+        if self.pooled:
+            if self._client is None:
+                self._client = await pool.get(self.address, self.priority)
+            return
+
+        if self._client is None:
+            self._client = BleakClient(self.address)
+
+        if not self._client.is_connected:
+            self._slot = await scheduler.open(self._client, self.priority)
+
+
+    async def disconnect(self):
+        """
+        Disconnect client. A pooled client is handed back to the pool, which
+        closes it once idle.
+        """
+
+        if self.pooled:
+            if self._client is not None:
+                self._client = None
+                await pool.release(self.address)
+            return
+
+        try:
+            await self._client.disconnect()
+        except:
+            pass
+
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+
+    def read_advertisement(self, device, advertisement):
+        results = None
+        key = 34818
+        if key not in advertisement.manufacturer_data:
+            return results
+
+        bufr = advertisement.manufacturer_data[key]
+        results = self._adverts.get(device.address, bufr, self.heartbeat)
+        if results is None:
+            try:
+                results = self.decode_state(int(bufr[-1]), advertisement)
+                self._adverts.put(device.address, bufr, results)
+            except Exception as x:
+                logger.warning(x)
+                return None
+
+        # the advertised state replaces a state recorded by a command, even
+        # when the payload is unchanged. the outlet may have been switched
+        # by hand since.
+        for outlet, state in enumerate(results.values(), 1):
+            states.update(device.address, outlet, state)
+
+        return results
+
+
+    def decode_state(self, value, advertisement):
+        """
+        Decode the outlet states byte of an advertisement
+        args:
+            - state byte (int)
+            - AdvertisementData
+        returns:
+            dict of {'outlet_1': state, ...}, in outlet order
+        """
+
+        return {'outlet_1': value}
+
+
+    async def on(self, outlet:int = 1, force:bool = False):
+        """
+        Switch device outlet ON
+        """
+
+        rval = await self.set_state(outlet, 1, force)
+        return rval
+
+
+    async def off(self, outlet:int = 1, force:bool = False):
+        """
+        Switch device outlet OFF
+        """
+
+        rval = await self.set_state(outlet, 0, force)
+        return rval
+
+
+    async def set_state(self, outlet:int, value:int, force:bool = False):
+        """
+        Switch an outlet. Commands to the same device are queued, and
+        pending commands coalesced (see OutletCommands).
+        Unless forced, the device is not contacted if it recently
+        advertised the requested state.
+        args:
+            - outlet number
+            - state (1 or 0)
+            - switch, even if already in the requested state?
+        returns:
+            the new state, or -1 if the device did not confirm it
+        """
+
+        if (not force and self.freshness and
+            outlet not in commands.pending(self.address)):
+            known = states.get(self.address, outlet, self.freshness)
+            if known is not None and bool(known) == bool(value):
+                record(self.stats, self.address, 'skipped', 1)
+                return value
+
+        started = time.monotonic()
+        result = await commands.submit(self.address, outlet, value,
+            self._apply)
+        record(self.stats, self.address, 'latency', time.monotonic() - started)
+        return result
+
+
+    async def _apply(self, batch:dict):
+        """
+        Set outlet states, in a single connection session
+        args:
+            - dict of {outlet: value}
+        returns:
+            dict of {outlet: new state, or -1 if not confirmed}
+        """
+
+        results = {}
+        await self.connect()
+        try:
+            for outlet, value in batch.items():
+                results[outlet] = await self._switch(outlet, value)
+        finally:
+            try:
+                if self._auto_disconnect:
+                    await self.disconnect()
+            except Exception as x:
+                logger.warning("Error disconnecting from device: %s" % x);
+
+        return results
+
+
+    async def _switch(self, outlet, value):
+        """
+        Write a switch command on the connected client, and wait for the
+        device to confirm it
+        returns:
+            the new state, or -1 if not confirmed
+        """
+
+        # an outlet the model does not have switches its first one
+        packets = self.code.SWITCH_PACKETS
+        state = int(bool(value))
+        if (outlet, state) not in packets:
+            outlet = 1
+        payload = packets[(outlet, state)]
+
+        tries = 2
+        found = False
+        retry = False
+        def confirms(data):
+            return data[:2] == self.code.STATE and int(bool(data[2])) == state
+
+        async with NotificationWaiter(self._client, self._rx, confirms,
+            tries * self.confirm_wait) as waiter:
+            while tries and not found:
+                await self.authenticate(force=retry)
+                await self._client.write_gatt_char(self._tx, payload)
+
+                found = await waiter.wait(self.confirm_wait) is not None
+                tries -= 1
+                retry = True
+
+        if not found:
+            # device may have dropped our authorization. re-send next time
+            self._authenticated.pop(self.address, None)
+            states.forget(self.address, outlet)
+            record(self.stats, self.address, 'unconfirmed', 1)
+            logger.warning("Outlet %s switch to %d not confirmed by %s" % (
+                outlet, value, self.address))
+            return -1
+
+        record(self.stats, self.address, 'confirmed', 1)
+        states.update(self.address, outlet, value)
+        self._state = value
+        return self._state
+
+
+    async def scan_key(self):
+        """
+        listen for device secret key code when button is pushed
+        """
+
+        def has_secret(data):
+            if not self._packet.validate(data):
+                # skip invalid packets
+                return False
+
+            return data[:3] == self.code.HAS_SECRET
+
+
+        if self.key_code is None:
+            await self.connect()
+            payload = self.code.WAIT_SECRET_PACKET
+            data = None
+            # tries = (self.ATTEMPTS * 4)
+            tries = 8
+            async with NotificationWaiter(self._client, self._rx, has_secret,
+                tries) as waiter:
+                while data is None and tries:
+                    try:
+                        await self._client.write_gatt_char(self._tx, payload)
+                    except:
+                        pass
+                    finally:
+                        data = await waiter.wait(1)
+                        tries -= 1
+
+            if data is not None:
+                self.key_code = [int(i) for i in data[3:11]]
+
+            if self._auto_disconnect:
+                await self.disconnect()
+
+        return self.key_code
+
+
+    async def authenticate(self, force=False):
+        """
+        Send the secret key code once per connection session
+        args:
+            - send it, even if already sent this session?
+        returns:
+            none
+        """
+
+        if self.pooled:
+            session = pool.slot(self.address)
+        else:
+            session = self._slot
+
+        if (not force and session is not None and
+            self._authenticated.get(self.address) is session):
+            return
+
+        await self.send_key()
+        self._authenticated[self.address] = session
+
+
+    async def send_key(self):
+        """
+        Send secret key code to device, for authorization to switch state
+        """
+
+        if self.key_code is None:
+            raise ValueError("No secret to tell")
+
+        payload = self._packet.build(
+            bytearray(
+                self.code.send_key + bytearray(self.key_code)))
+        await self._client.write_gatt_char(self._tx, payload)
+
+
+# shared command queues and outlet states, for all outlet plugins
+commands = OutletCommands()
+states = OutletStates()
@@ -0,0 +1,90 @@
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class RangeValidator:
+    """
+    Check decoded device readings against a table of valid ranges.
+
+    The table, like {'battery': (0, 100), 'temperature': (-20, 60)}, is
+    compiled once into a tuple of (field, min, max) checks, so validating a
+    reading does no work beyond the comparisons. Plugins create one per
+    class, from their limits table.
+
+    Invalid readings are logged at most once per interval seconds for each
+    device, with a count of the readings rejected since the last warning,
+    so a misbehaving sensor cannot flood the log.
+    """
+
+    def __init__(self, limits, interval=300, *args, **kwargs):
+        self.checks = tuple((k, low, high) for k, (low, high) in limits.items())
+        self.interval = interval
+
+        # {device address: [monotonic time of last warning, suppressed]}
+        self._warned = {}
+
+
+    def __call__(self, values, device=None):
+        """
+        Validate a reading
+        args:
+            - dict of decoded values
+            - device address, for the warning (optional)
+        returns:
+            Boolean (True if all values are present and in range)
+        """
+
+        try:
+            for key, low, high in self.checks:
+                if not low <= values[key] <= high:
+                    break
+            else:
+                return True
+        except (KeyError, TypeError):
+            pass
+
+        self.reject(device, key, values)
+        return False
+
+
+    def reject(self, device, field, values=None):
+        """
+        Report an invalid reading, unless this device was reported less
+        than interval seconds ago.
+        args:
+            - device address
+            - name of the invalid field (or 'advertisement', etc)
+            - the invalid reading (optional)
+        returns:
+            none
+        """
+
+        now = time.monotonic()
+        state = self._warned.get(device)
+        if state is not None and now - state[0] < self.interval:
+            state[1] += 1
+            return
+
+        if state is not None and state[1]:
+            logger.warning("Invalid %s value from %s: %s "
+                "(and %d more in %ds)" % (field, device, values, state[1],
+                now - state[0]))
+        else:
+            logger.warning("Invalid %s value from %s: %s" % (
+                field, device, values))
+
+        self._warned[device] = [now, 0]
+
+
+    def forget(self, device=None):
+        """
+        Reset the warning state of one device, or of all of them
+        """
+
+        if device is None:
+            self._warned.clear()
+        else:
+            self._warned.pop(device, None)
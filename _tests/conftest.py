@@ -0,0 +1,41 @@
+"""
+Tests run offline, against the stand-in modules of the benchmark suite
+(_bench/stubs.py): bleak, the potnanny database (in-memory SQLite) and the
+Control model. Run from the plugin directory:
+
+    python -m pytest -q _tests
+"""
+
+import os
+import sys
+import asyncio
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from _bench import stubs
+
+
+database = stubs.install()
+
+
+@pytest.fixture
+def db():
+    """
+    The stand-in database, emptied, with no simulated query delay
+    """
+
+    database.clear()
+    database.delay = 0
+    return database
+
+
+@pytest.fixture
+def run():
+    """
+    Run a coroutine to completion, on a new event loop
+    """
+
+    return asyncio.run
@@ -0,0 +1,77 @@
+import random
+import types
+import pytest
+from _bench import stubs
+
+
+np = pytest.importorskip('numpy')
+
+switchbot = stubs.load('device/ble/switchbot_hygrometer.py')
+switchbot_plus = stubs.load('device/ble/switchbot_plus_hygrometer.py')
+h5082 = stubs.load('device/ble/govee_h5082_outlet.py')
+from _lib.batch import to_records
+from _lib.advertisement import AdvertisementCache
+
+
+SWITCHBOT = '0000fd3d-0000-1000-8000-00805f9b34fb'
+GOVEE = 34818
+
+
+def payloads(seed, count=500, longest=8):
+    """
+    Random payloads, of random length up to longest bytes. Many are too
+    short, or decode to out of range values.
+    """
+
+    r = random.Random(seed)
+    return [bytes(r.randrange(256) for _ in range(r.randrange(longest + 1)))
+        for _ in range(count)]
+
+
+def device(i):
+    return types.SimpleNamespace(address='A4:C1:38:%02X:%02X:%02X' % (
+        i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff))
+
+
+@pytest.mark.parametrize('plugin', [
+    switchbot.SwitchbotHygrometer,
+    switchbot_plus.SwitchbotPlusHygrometer])
+def test_switchbot_batch_matches_single(plugin, monkeypatch):
+    # decode every payload, instead of returning cached values
+    monkeypatch.setattr(plugin, '_adverts', AdvertisementCache())
+    data = payloads(6) + [bytes([0, 0, 0x5a, 5, 0x96, 40]),
+        bytes([0, 0, 0x5a, 5, 0x13, 40])]
+
+    columns = plugin.read_advertisements(data)
+    batch = to_records(columns, {'temperature': float, 'humidity': int,
+        'battery': int})
+
+    single = [plugin().read_advertisement(device(i),
+        types.SimpleNamespace(service_data={SWITCHBOT: p}))
+        for i, p in enumerate(data)]
+
+    assert batch == single
+    assert batch[-2:] == [
+        {'temperature': 22.5, 'humidity': 40, 'battery': 90},
+        {'temperature': -19.5, 'humidity': 40, 'battery': 90}]
+    # both valid and rejected payloads were compared
+    assert 0 < columns['valid'].sum() < len(data)
+
+
+@pytest.mark.parametrize('name', ['ihoment_H5082_1A2B', 'ihoment_H5080_1A2B'])
+def test_govee_batch_matches_single(name, monkeypatch):
+    monkeypatch.setattr(h5082.GoveeH5082, '_adverts', AdvertisementCache())
+    data = payloads(6, longest=4) + [b'\xec\x00\x01\x01\x01\x02', b'']
+
+    columns = h5082.GoveeH5082.read_advertisements(data, [name] * len(data))
+    batch = to_records(columns, {'outlet_1': int, 'outlet_2': int})
+
+    single = []
+    for i, p in enumerate(data):
+        plugin = h5082.GoveeH5082(address=device(i).address)
+        single.append(plugin.read_advertisement(device(i),
+            types.SimpleNamespace(manufacturer_data={GOVEE: p},
+                local_name=name)))
+
+    assert batch == single
+    assert batch[-1] is None
@@ -0,0 +1,122 @@
+import asyncio
+from _bench import stubs
+
+
+stubs.install()
+from _lib.ble import ConnectionScheduler, ConnectionPool
+
+
+def test_scheduler_limit(run):
+    scheduler = ConnectionScheduler(max_connections=2)
+
+    async def main():
+        slots = [await scheduler.acquire('A'), await scheduler.acquire('B')]
+        waiter = asyncio.create_task(scheduler.acquire('C'))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        assert scheduler.waiting() == 1
+
+        slots[0].release()
+        # a second release of the same slot frees nothing
+        slots[0].release()
+        slot = await waiter
+        assert scheduler.waiting() == 0
+        assert scheduler._adapter(None)['active'] == 2
+
+        slot.release()
+        slots[1].release()
+        assert scheduler._adapter(None)['active'] == 0
+
+    run(main())
+
+
+def test_scheduler_priority(run):
+    scheduler = ConnectionScheduler(max_connections=1)
+    order = []
+
+    async def wait(address, priority):
+        slot = await scheduler.acquire(address, priority)
+        order.append(address)
+        slot.release()
+
+    async def main():
+        held = await scheduler.acquire('held')
+        tasks = [asyncio.create_task(wait(a, p))
+            for a, p in (('low', 5), ('high', 1), ('mid', 3), ('high2', 1))]
+        await asyncio.sleep(0)
+        held.release()
+        await asyncio.gather(*tasks)
+
+    run(main())
+    assert order == ['high', 'high2', 'mid', 'low']
+
+
+def test_scheduler_cancelled_waiter(run):
+    scheduler = ConnectionScheduler(max_connections=1)
+
+    async def main():
+        held = await scheduler.acquire('A')
+        waiter = asyncio.create_task(scheduler.acquire('B'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        held.release()
+        slot = await asyncio.wait_for(scheduler.acquire('C'), 1)
+        slot.release()
+        assert scheduler._adapter(None)['active'] == 0
+
+    run(main())
+
+
+def test_pool_reuses_connection(run):
+    scheduler = ConnectionScheduler(max_connections=3)
+    pool = ConnectionPool(scheduler=scheduler, idle_timeout=0.01)
+
+    async def main():
+        client = await pool.get('A')
+        session = pool.slot('A')
+        await pool.release('A')
+
+        assert await pool.get('A') is client
+        assert pool.slot('A') is session
+        assert client.is_connected
+        await pool.release('A')
+
+        # link lost while idle: the slot is freed, and the next get
+        # reconnects
+        await client.disconnect()
+        assert pool.slot('A') is None
+        assert await pool.get('A') is client
+        assert client.is_connected
+        assert pool.slot('A') is not session
+        await pool.release('A')
+
+        # closed once idle
+        await asyncio.sleep(0.05)
+        assert pool.slot('A') is None
+        assert not client.is_connected
+        assert scheduler._adapter(None)['active'] == 0
+
+    run(main())
+
+
+def test_pool_full(run):
+    scheduler = ConnectionScheduler(max_connections=3)
+    pool = ConnectionPool(scheduler=scheduler, max_size=1)
+
+    async def main():
+        a = await pool.get('A')
+        # the pool is full and A is in use, so B is not pooled
+        b = await pool.get('B')
+        await pool.release('B')
+        assert not b.is_connected
+
+        # A is idle now, and makes room for C
+        await pool.release('A')
+        c = await pool.get('C')
+        assert not a.is_connected
+        assert c.is_connected
+        await pool.close()
+        assert scheduler._adapter(None)['active'] == 0
+
+    run(main())
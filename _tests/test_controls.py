@@ -0,0 +1,52 @@
+import pytest
+from _bench import stubs
+
+
+ControlPipeline = stubs.load('pipeline/controls.py').ControlPipeline
+from potnanny.models.control import Control
+from potnanny.plugins import PipelinePlugin
+
+
+def attributes(device_id, kind='temperature'):
+    return {'input_device_id': device_id, 'type': kind}
+
+
+@pytest.fixture
+def controls(monkeypatch):
+    monkeypatch.setattr(Control, 'rows', [])
+    ControlPipeline.invalidate()
+    yield ControlPipeline
+    ControlPipeline.invalidate()
+
+
+def test_routes_invalidated(run, controls):
+    async def main():
+        first = await Control.create(device_id=9, attributes=attributes(1))
+        assert list(await controls.routes()) == [(1, 'temperature')]
+
+        await Control.create(device_id=9, attributes=attributes(2))
+        assert len(await controls.routes()) == 2
+
+        await first.delete_instance()
+        return await controls.routes()
+
+    assert list(run(main())) == [(2, 'temperature')]
+
+
+def test_routes_invalidated_after_reload(run, controls):
+    reloaded = stubs.reload('pipeline/controls.py').ControlPipeline
+    try:
+        async def main():
+            assert await reloaded.routes() == {}
+            await Control.create(device_id=9, attributes=attributes(1))
+            # the model hooks were installed by the first load
+            assert list(await reloaded.routes()) == [(1, 'temperature')]
+            assert list(await controls.routes()) == [(1, 'temperature')]
+
+            reloaded.invalidate()
+            Control.rows.clear()
+            return await controls.routes()
+
+        assert run(main()) == {}
+    finally:
+        PipelinePlugin.plugins.remove(reloaded)
@@ -0,0 +1,190 @@
+import asyncio
+import pytest
+from _bench import stubs
+
+
+module = stubs.load('pipeline/db.py')
+DBPipeline = module.DBPipeline
+
+
+def measurements(count, start=0):
+    return [{'device_id': 1, 'type': 'temperature', 'value': float(i)}
+        for i in range(start, start + count)]
+
+
+def values(db):
+    return [r[0] for r in db.conn.execute(
+        "SELECT value FROM measurement ORDER BY id")]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """
+    DBPipeline with its class state reset, and fast write-behind timing
+    """
+
+    monkeypatch.setattr(DBPipeline, 'flush_ms', 10)
+    monkeypatch.setattr(DBPipeline, 'retry_seconds', 0.01)
+    monkeypatch.setattr(DBPipeline, 'dropped', 0)
+    monkeypatch.setattr(DBPipeline, 'filtered', 0)
+    monkeypatch.setattr(DBPipeline, '_last', {})
+    yield DBPipeline
+    DBPipeline._queue = None
+    DBPipeline._writer = None
+    DBPipeline._inflight = None
+
+
+def test_write(db, run, pipeline):
+    async def main():
+        await pipeline().input(measurements(5) + [
+            {'device_id': 1, 'type': 'temperature', 'value': None},
+            {'device_id': 'x', 'type': 'temperature', 'value': 1.0}])
+
+    run(main())
+    assert values(db) == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_write_behind(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'write_behind', True)
+
+    async def main():
+        await pipeline().input(measurements(10))
+        await pipeline.flush()
+        written = values(db)
+        await pipeline.shutdown()
+        return written
+
+    assert run(main()) == [float(i) for i in range(10)]
+
+
+@pytest.mark.parametrize('overflow, expected', [
+    ('drop_newest', [0.0, 1.0, 2.0, 3.0, 4.0]),
+    ('drop_oldest', [3.0, 4.0, 5.0, 6.0, 7.0])])
+def test_overflow_drop(db, run, pipeline, monkeypatch, overflow, expected):
+    monkeypatch.setattr(pipeline, 'write_behind', True)
+    monkeypatch.setattr(pipeline, 'queue_size', 5)
+    monkeypatch.setattr(pipeline, 'overflow', overflow)
+
+    async def main():
+        # the writer task does not run until input() yields, so the queue
+        # overflows within this one call
+        await pipeline().input(measurements(8))
+        await pipeline.shutdown()
+
+    run(main())
+    assert pipeline.dropped == 3
+    assert values(db) == expected
+
+
+def test_overflow_block(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'write_behind', True)
+    monkeypatch.setattr(pipeline, 'queue_size', 2)
+    monkeypatch.setattr(pipeline, 'overflow', 'block')
+
+    async def main():
+        await pipeline().input(measurements(20))
+        await pipeline.shutdown()
+
+    run(main())
+    assert pipeline.dropped == 0
+    assert values(db) == [float(i) for i in range(20)]
+
+
+def test_failed_write_is_retried(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'write_behind', True)
+    write = pipeline._write
+    failures = [2]
+
+    async def flaky(self, rows, locked=True):
+        if failures[0]:
+            failures[0] -= 1
+            raise RuntimeError("database is locked")
+        return await write(self, rows, locked)
+
+    monkeypatch.setattr(pipeline, '_write', flaky)
+
+    async def main():
+        await pipeline().input(measurements(10))
+        await pipeline.flush()
+        await pipeline.shutdown()
+
+    run(main())
+    assert failures == [0]
+    assert values(db) == [float(i) for i in range(10)]
+
+
+def test_dead_writer_keeps_queue(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'write_behind', True)
+    monkeypatch.setattr(pipeline, 'flush_ms', 60000)
+
+    async def main():
+        await pipeline().input(measurements(10))
+        # let the writer take the rows, and wait for more
+        await asyncio.sleep(0.01)
+        assert pipeline._inflight
+        queue = pipeline._queue
+        pipeline._writer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await pipeline._writer
+
+        await pipeline().input(measurements(5, start=10))
+        assert pipeline._queue is queue
+        await pipeline.shutdown()
+
+    run(main())
+    assert values(db) == [float(i) for i in range(15)]
+
+
+def test_dedicated_writer_reconnects(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'dedicated_writer', True)
+    connection = module.db.connection
+    failures = [2]
+
+    def connect():
+        if failures[0]:
+            failures[0] -= 1
+            raise ConnectionError("unable to open database file")
+        return connection()
+
+    monkeypatch.setattr(module.db, 'connection', connect)
+
+    async def main():
+        await pipeline().input(measurements(10))
+        await pipeline.flush()
+        alive = not pipeline._writer.done()
+        await pipeline.shutdown()
+        return alive
+
+    assert run(main())
+    assert failures == [0]
+    assert values(db) == [float(i) for i in range(10)]
+
+
+def test_deadband(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'deadband', 0.5)
+    monkeypatch.setattr(pipeline, 'deadbands', {'humidity': (None, 0.1)})
+
+    async def main():
+        for value in (20.0, 20.2, 20.4, 20.6, 20.7, 19.0):
+            await pipeline().input([
+                {'device_id': 1, 'type': 'temperature', 'value': value}])
+        for value in (50.0, 54.0, 56.0):
+            await pipeline().input([
+                {'device_id': 1, 'type': 'humidity', 'value': value}])
+
+    run(main())
+    assert values(db) == [20.0, 20.6, 19.0, 50.0, 56.0]
+    assert pipeline.filtered == 4
+
+
+def test_deadband_heartbeat(db, run, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'deadband', 0)
+    monkeypatch.setattr(pipeline, 'heartbeat', 0)
+
+    async def main():
+        for i in range(3):
+            await pipeline().input([
+                {'device_id': 1, 'type': 'temperature', 'value': 20.0}])
+
+    run(main())
+    assert values(db) == [20.0, 20.0, 20.0]
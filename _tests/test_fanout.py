@@ -0,0 +1,196 @@
+import copy
+import asyncio
+import pytest
+from _bench import stubs
+
+
+FanoutPipeline = stubs.load('pipeline/fanout.py').FanoutPipeline
+from potnanny.plugins import PipelinePlugin
+from _lib.lanes import owned
+
+
+class Recorder:
+    """
+    Pipeline plugin test double. Records the batches it receives, and
+    waits for its gate (if closed) before returning.
+    """
+
+    received = None
+    gate = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+    async def input(self, measurements):
+        if owned(self):
+            return
+
+        cls = type(self)
+        if cls.gate is not None:
+            await cls.gate.wait()
+        cls.received.append([m['value'] for m in measurements])
+
+
+class FastRecorder(Recorder, PipelinePlugin):
+    pass
+
+
+class SlowRecorder(Recorder, PipelinePlugin):
+    pass
+
+
+def batch(value):
+    return [{'device_id': 1, 'type': 'temperature', 'value': float(value)}]
+
+
+async def pipeline_input(measurements):
+    """
+    Deliver a batch like potnanny's Pipeline does, to this module's plugins
+    """
+
+    plugins = [p for p in PipelinePlugin.plugins
+        if p in (FastRecorder, SlowRecorder, FanoutPipeline)]
+    await asyncio.gather(*[p().input(copy.deepcopy(measurements))
+        for p in plugins])
+
+
+@pytest.fixture
+def fanout(monkeypatch):
+    for p in (FastRecorder, SlowRecorder):
+        monkeypatch.setattr(p, 'received', [])
+        monkeypatch.setattr(p, 'gate', None)
+    yield FanoutPipeline
+    FanoutPipeline._lanes = None
+
+
+def test_lanes_deliver(run, fanout, monkeypatch):
+    monkeypatch.setattr(fanout, 'lanes', [
+        {'name': 'fast', 'plugins': ['FastRecorder']},
+        {'name': 'slow', 'plugins': ['SlowRecorder'], 'priority': 1}])
+
+    async def main():
+        for i in range(5):
+            await pipeline_input(batch(i))
+
+        await fanout.flush()
+        status = fanout.status()
+        await fanout.shutdown()
+        return status
+
+    status = run(main())
+    expected = [[float(i)] for i in range(5)]
+    assert FastRecorder.received == expected
+    assert SlowRecorder.received == expected
+    # every batch, the first one too, went through the lanes. the lane
+    # plugins are still registered, for the api plugin list.
+    assert status['fast']['processed'] == 5
+    assert FastRecorder in PipelinePlugin.plugins
+    assert status['slow']['depth'] == 0
+
+
+def test_slow_lane_does_not_block(run, fanout, monkeypatch):
+    monkeypatch.setattr(fanout, 'lanes', [
+        {'name': 'fast', 'plugins': ['FastRecorder']},
+        {'name': 'slow', 'plugins': ['SlowRecorder'], 'priority': 1}])
+
+    async def main():
+        await pipeline_input(batch(0))
+        await fanout.flush()
+        SlowRecorder.gate = asyncio.Event()
+        for i in range(1, 4):
+            await asyncio.wait_for(pipeline_input(batch(i)), 1)
+        await asyncio.wait_for(fanout._lanes[0].queue.join(), 1)
+
+        fast = list(FastRecorder.received)
+        slow = list(SlowRecorder.received)
+        SlowRecorder.gate.set()
+        await fanout.shutdown()
+        return fast, slow
+
+    fast, slow = run(main())
+    assert fast == [[0.0], [1.0], [2.0], [3.0]]
+    assert slow == [[0.0]]
+    assert SlowRecorder.received == fast
+
+
+def test_priority(run, fanout, monkeypatch):
+    order = []
+
+    class Yielding(Recorder):
+        async def input(self, measurements):
+            await asyncio.sleep(0)
+            order.append(type(self).__name__)
+
+    monkeypatch.setattr(FastRecorder, 'input', Yielding.input)
+    monkeypatch.setattr(SlowRecorder, 'input', Yielding.input)
+    monkeypatch.setattr(fanout, 'lanes', [
+        {'name': 'low', 'plugins': ['SlowRecorder'], 'priority': 1},
+        {'name': 'high', 'plugins': ['FastRecorder'], 'priority': 0}])
+
+    async def main():
+        await pipeline_input(batch(0))
+        await fanout.flush()
+        order.clear()
+        for i in range(1, 4):
+            await fanout().input(batch(i))
+        await fanout.shutdown()
+
+    run(main())
+    # the low lane waits while the high lane has batches queued, so it
+    # starts no earlier than the last high priority batch
+    assert order.count('FastRecorder') == order.count('SlowRecorder') == 3
+    assert order.index('SlowRecorder') >= 2
+
+
+@pytest.mark.parametrize('overflow, expected', [
+    ('drop_newest', [[1.0]]),
+    ('drop_oldest', [[3.0]])])
+def test_overflow(run, fanout, monkeypatch, overflow, expected):
+    monkeypatch.setattr(fanout, 'lanes', [
+        {'name': 'lane', 'plugins': ['FastRecorder'], 'size': 1,
+         'overflow': overflow}])
+
+    async def main():
+        await pipeline_input(batch(0))
+        await fanout.flush()
+        FastRecorder.received.clear()
+        # the consumer does not run until input() yields, so the lane
+        # queue overflows
+        for i in range(1, 4):
+            await fanout().input(batch(i))
+        status = fanout.status()
+        await fanout.shutdown()
+        return status
+
+    status = run(main())
+    assert status['lane']['dropped'] == 2
+    assert FastRecorder.received == expected
+
+
+def test_reloaded_fanout(run, fanout, monkeypatch):
+    lanes = [{'name': 'fast', 'plugins': ['FastRecorder']}]
+    monkeypatch.setattr(fanout, 'lanes', lanes)
+    reloaded = stubs.reload('pipeline/fanout.py').FanoutPipeline
+    monkeypatch.setattr(reloaded, 'lanes', lanes)
+
+    async def main():
+        try:
+            # the old class does nothing, and the newest runs the lanes
+            await fanout().input(batch(0))
+            assert fanout.status() == {}
+            await reloaded().input(batch(1))
+            await reloaded.flush()
+            status = reloaded.status()
+        finally:
+            await reloaded.shutdown()
+            PipelinePlugin.plugins.remove(reloaded)
+
+        # without the newer class, the old one runs the lanes again
+        await fanout().input(batch(2))
+        await fanout.shutdown()
+        return status
+
+    status = run(main())
+    assert status['fast']['processed'] == 1
+    assert FastRecorder.received == [[1.0], [2.0]]
@@ -0,0 +1,113 @@
+import copy
+import math
+import datetime
+import pytest
+import marshmallow
+from _bench import stubs
+
+
+stubs.install()
+from potnanny.models.measurement import MeasurementSchema
+from _lib.measurement import (Record, MeasurementBatch, validate, adapt,
+    type_code, type_name)
+
+
+CREATED = datetime.datetime(2026, 1, 1, 12, 30)
+
+VALID = [
+    {'device_id': 1, 'type': 'temperature', 'value': 21.5, 'created': CREATED},
+    {'device_id': '2', 'type': 'humidity', 'value': 40, 'created': CREATED},
+    {'device_id': 3, 'type': ' soil_moisture ', 'value': '12.5',
+        'created': CREATED},
+    {'device_id': 4, 'type': '<b>light</b>', 'value': 0, 'created': CREATED},
+    {'device_id': 5, 'type': 'battery', 'value': 99.0, 'created': CREATED,
+        'device_name': 'kitchen'},
+]
+
+INVALID = [
+    {'device_id': 1, 'type': 'temperature', 'value': None},
+    {'device_id': 1, 'type': 'temperature', 'value': 'warm'},
+    {'device_id': 1, 'type': 'temperature', 'value': True},
+    {'device_id': 1, 'type': 'temperature', 'value': math.nan},
+    {'device_id': 'one', 'type': 'temperature', 'value': 1.0},
+    {'device_id': 1, 'type': None, 'value': 1.0},
+]
+
+# the schema fields are not required, so these load, and then fail to
+# insert (the columns are NOT NULL). validate() leaves them out up front.
+INCOMPLETE = [
+    {'device_id': 1, 'type': 'temperature'},
+    {'type': 'temperature', 'value': 1.0},
+]
+
+
+def schema_records(measurements):
+    # SafeSchema escapes the type strings in place
+    loaded = MeasurementSchema(many=True).load(copy.deepcopy(measurements))
+    return [Record(m['device_id'], m['type'], m['value'], m.get('created'))
+        for m in loaded]
+
+
+def test_validate_matches_schema():
+    assert validate(VALID) == schema_records(VALID)
+
+
+@pytest.mark.parametrize('measurement', INVALID)
+def test_validate_rejects_like_schema(measurement):
+    with pytest.raises(marshmallow.ValidationError):
+        MeasurementSchema(many=True).load([measurement])
+
+    assert validate([measurement]) == []
+
+
+@pytest.mark.parametrize('measurement', INCOMPLETE)
+def test_validate_rejects_incomplete(measurement):
+    assert validate([measurement]) == []
+
+
+def test_validate_leaves_out_invalid():
+    records = validate(INVALID[:3] + VALID + INVALID[3:] + INCOMPLETE)
+    assert records == schema_records(VALID)
+
+
+def test_validate_created_default():
+    record, = validate([{'device_id': 1, 'type': 't', 'value': 1.0}])
+    assert record.created.second == 0
+    assert record.created.microsecond == 0
+
+
+def test_validate_passes_records():
+    records = validate(VALID)
+    assert validate(records) == records
+
+
+def test_batch():
+    extra = []
+    records = validate(VALID, extra=extra)
+    batch = MeasurementBatch.from_dicts(VALID)
+
+    assert len(batch) == len(VALID)
+    assert batch.records() == records
+    assert validate(batch) == records
+    assert [type_name(c) for c in batch.types] == [r.type for r in records]
+    assert batch.types[0] == type_code('temperature')
+
+    dicts = batch.to_dicts()
+    assert dicts[4]['device_name'] == 'kitchen'
+    assert 'device_name' not in dicts[0]
+    # type strings were escaped once already
+    assert validate(dicts, sanitize=False) == records
+    assert extra[4] == {'device_name': 'kitchen'}
+
+
+def test_adapt():
+    class Columnar:
+        columnar = True
+
+    class Plain:
+        pass
+
+    batch = MeasurementBatch.from_dicts(VALID)
+    assert adapt(batch, Columnar) is batch
+    assert adapt(batch, Plain) == batch.to_dicts()
+    assert adapt(VALID, Plain) is VALID
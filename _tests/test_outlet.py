@@ -0,0 +1,143 @@
+import types
+import asyncio
+import pytest
+from _bench import stubs
+
+
+h5080 = stubs.load('device/ble/govee_h5080_outlet.py')
+h5082 = stubs.load('device/ble/govee_h5082_outlet.py')
+from _lib.outlet import OutletCommands, OutletStates, PacketManager, states
+
+
+def test_commands_coalesce(run):
+    commands = OutletCommands()
+    applied = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def apply(batch):
+            applied.append(batch)
+            await release.wait()
+            return {outlet: value for outlet, value in batch.items()}
+
+        first = asyncio.create_task(commands.submit('AA', 1, 1, apply))
+        await asyncio.sleep(0)
+        assert commands.pending('AA') == {1: 1}
+
+        # queued while the first batch is applied. outlet 1 is switched
+        # twice, and only the last state is sent.
+        queued = [
+            asyncio.create_task(commands.submit('AA', 1, 0, apply)),
+            asyncio.create_task(commands.submit('AA', 2, 1, apply)),
+            asyncio.create_task(commands.submit('AA', 1, 1, apply))]
+        await asyncio.sleep(0)
+        assert commands.pending('AA') == {1: 1, 2: 1}
+
+        release.set()
+        return await first, await asyncio.gather(*queued)
+
+    first, queued = run(main())
+    assert applied == [{1: 1}, {1: 1, 2: 1}]
+    assert first == 1
+    # the superseded command gets the result of the one that replaced it
+    assert queued == [1, 1, 1]
+    assert commands.pending('AA') == {}
+
+
+def test_commands_failure(run):
+    commands = OutletCommands()
+
+    async def apply(batch):
+        raise RuntimeError("not connected")
+
+    async def main():
+        results = await asyncio.gather(
+            commands.submit('AA', 1, 1, apply),
+            commands.submit('AA', 2, 0, apply),
+            return_exceptions=True)
+        return results
+
+    results = run(main())
+    assert [type(r) for r in results] == [RuntimeError, RuntimeError]
+
+
+def test_states():
+    states = OutletStates()
+    states.update('aa:bb', 1, 1)
+    assert states.get('AA:BB', 1, 10) == 1
+    assert states.get('AA:BB', 2, 10) is None
+    assert states.get('AA:BB', 1, -1) is None
+
+    states.forget('AA:BB', 1)
+    assert states.get('AA:BB', 1, 10) is None
+
+
+def test_packets():
+    packets = PacketManager(default_sz=20)
+    data = packets.template(b'\x33\x01\x23')
+    assert len(data) == 20
+    assert packets.validate(data)
+    assert not packets.validate(data[:19])
+    assert not packets.validate(data[:19] + b'\x00')
+
+
+class OutletClient(stubs.BleakClient):
+    """
+    Client that answers each switch command with the given STATE
+    notifications
+    """
+
+    def __init__(self, address, replies):
+        super().__init__(address)
+        self.replies = replies
+        self.writes = []
+
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        self.writes.append(bytes(data))
+        if bytes(data[:2]) == h5082.H5082Code.SWITCH:
+            for reply in self.replies:
+                for callback in self._notify.values():
+                    callback(None, reply)
+
+
+def state(value):
+    return PacketManager().template(h5082.H5082Code.STATE + bytes([value]))
+
+
+@pytest.mark.parametrize('replies, expected', [
+    ([state(1)], 1),
+    ([state(0)], -1),
+    ([PacketManager().template(h5082.H5082Code.FIRMWARE + b'\x01')], -1),
+    ([state(0), state(1)], 1)])
+def test_h5082_confirms(run, replies, expected):
+    plugin = h5082.GoveeH5082(address='A4:C1:38:00:00:01', key_code=[1] * 8)
+    plugin.pooled = False
+    plugin.confirm_wait = 0.01
+    plugin._client = OutletClient(plugin.address, replies)
+
+    assert run(plugin._switch(1, 1)) == expected
+
+
+def test_advertised_state_replaces_command_state(run):
+    address = 'A4:C1:38:00:00:80'
+    plugin = h5080.GoveeH5080(address=address, key_code=[1] * 8)
+    plugin.pooled = False
+    plugin.confirm_wait = 0.01
+    plugin._client = OutletClient(address, [state(1)])
+
+    device = types.SimpleNamespace(address=address)
+    advertisement = types.SimpleNamespace(local_name='ihoment_H5080_1A2B',
+        manufacturer_data={34818: b'\xec\x00\x01\x01\x01\x00'})
+
+    assert plugin.read_advertisement(device, advertisement) == {'outlet_1': 0}
+    # switched on by a command, then off by hand. the device advertises
+    # the same OFF payload as before.
+    states.update(address, 1, 1)
+    assert plugin.read_advertisement(device, advertisement) == {'outlet_1': 0}
+    assert states.get(address, 1, plugin.freshness) == 0
+
+    assert run(plugin.on(1)) == 1
+    assert 'skipped' not in plugin.stats.get(address, {})
+    assert h5080.H5080Code.SWITCH_PACKETS[(1, 1)] in plugin._client.writes
@@ -1,10 +1,29 @@
 import re
+import struct
 import logging
+import os
+import sys
 from potnanny.plugins import BluetoothDevicePlugin
 from potnanny.plugins.mixins import FingerprintMixin
 
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.advertisement import AdvertisementCache
+from _lib.batch import decode_switchbot
+from _lib.validate import RangeValidator
+
 logger = logging.getLogger(__name__)
 
+# service data bytes 2-5: battery, temperature tenths, temperature (bit 7
+# set when above zero), humidity. the top bit of battery and humidity is
+# not part of the value.
+_frame = struct.Struct('<2x4B')
+
 # version 1.1
 
 class SwitchbotHygrometer(BluetoothDevicePlugin, FingerprintMixin):
@@ -20,75 +39,67 @@ class SwitchbotHygrometer(BluetoothDevicePlugin, FingerprintMixin):
         'name': re.compile('^EB-B3-0E', re.IGNORECASE)
     }
 
+    # seconds before an unchanged advertisement is decoded again
+    heartbeat = 60
+    _adverts = AdvertisementCache()
+
+    # valid measurement ranges
+    limits = {
+        'battery': (0, 100),
+        'temperature': (-20, 60),
+        'humidity': (0, 100) }
+    validator = RangeValidator(limits)
+
     def __init__(self, *args, **kwargs):
         pass
 
 
     def read_advertisement(self, device, advertisement):
-        results = {}
         uuid = '0000fd3d-0000-1000-8000-00805f9b34fb'
-        # uuid = '00000d00-0000-1000-8000-00805f9b34fb'
 
-
-        if (hasattr(advertisement, 'service_data') and 
-            uuid in advertisement.service_data):
+        try:
             data = advertisement.service_data[uuid]
+        except (AttributeError, KeyError):
+            self.validator.reject(device.address, 'advertisement',
+                advertisement)
+            return None
 
-            battery = data[2] & 0b01111111
-            humidity = data[5] & 0b01111111
-
-            temperature = (data[3] & 0b00001111) / 10 + (data[4] & 0b01111111)
-            above_zero = data[4] & 0b10000000
-            if not above_zero:
-                temperature = -temperature
-            
-            results = {
-                'temperature': temperature,
-                'humidity': humidity,
-                'battery': battery
-            }
-        else:
-            logger.warning(f"Unrecognized advertisement data: {advertisement}")
+        results = self._adverts.get(device.address, data, self.heartbeat)
+        if results is not None:
+            return results
+
+        try:
+            battery, tenths, whole, humidity = _frame.unpack_from(data)
+        except struct.error:
+            self.validator.reject(device.address, 'advertisement', data)
             return None
 
-        if self._validate(results):
+        temperature = (tenths & 0b00001111) / 10 + (whole & 0b01111111)
+        if not whole & 0b10000000:
+            temperature = -temperature
+
+        results = {
+            'temperature': temperature,
+            'humidity': humidity & 0b01111111,
+            'battery': battery & 0b01111111
+        }
+
+        if self.validator(results, device.address):
+            self._adverts.put(device.address, data, results)
             return results
         else:
             return None
 
 
-    def _validate(self, m):
+    @classmethod
+    def read_advertisements(cls, payloads):
         """
-        Validate the measurements. Make sure they are in expected ranges.
+        Decode many raw service data payloads at once (for backfill, replay
+        and high-rate gateways). Requires numpy.
         args:
-            - dict
+            - list of service data payloads (bytes)
         returns:
-            Boolean (True if all measurements are valid)
+            dict of numpy arrays (temperature, humidity, battery, valid)
         """
 
-        if (m is None or type(m) is not dict or len(m.keys()) < 1):
-            return False
-
-        if ('battery' not in m or 
-            m['battery'] is None or 
-            m['battery'] < 0 or 
-            m['battery'] > 100):
-            logger.warning("Invalid battery value %s" % m)
-            return False
-
-        if ('temperature' not in m or 
-            m['temperature'] is None or 
-            m['temperature'] < -20 or 
-            m['temperature'] > 60):
-            logger.warning("Invalid temperature value %s" % m)
-            return False
-
-        if ('humidity' not in m or 
-            m['humidity'] is None or 
-            m['humidity'] < 0 or 
-            m['humidity'] > 100):
-            logger.warning("Invalid humidity value %s" % m)
-            return False
-
-        return True
-
+        return decode_switchbot(payloads, cls.limits)
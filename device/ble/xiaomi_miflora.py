@@ -1,12 +1,28 @@
 import re
+import time
+import struct
 import logging
-import asyncio
-from bleak import BleakClient
+import os
+import sys
 from potnanny.plugins import BluetoothDevicePlugin
 from potnanny.plugins.mixins import FingerprintMixin
 
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.ble import scheduler
+from _lib.validate import RangeValidator
+
 logger = logging.getLogger(__name__)
 
+# 16 byte measurement block: temperature (tenths of a degree), unused,
+# light (lux), soil moisture (%), soil conductivity (uS/cm), unused
+_block = struct.Struct('<hxIBH6x')
+
 # version 1.1
 
 class MiFlora(BluetoothDevicePlugin, FingerprintMixin):
@@ -18,6 +34,26 @@ class MiFlora(BluetoothDevicePlugin, FingerprintMixin):
         'name': re.compile(r'flower\s+(care|mate)', re.IGNORECASE)
     }
 
+    # connection priority, lower numbers are served first
+    priority = 10
+
+    # Firmware never changes, so it is read once per device for the life of
+    # the process. Battery drains over weeks, so it is only re-read every
+    # battery_polls polls, or once battery_seconds have passed.
+    battery_polls = 24
+    battery_seconds = 86400
+    _firmware = {}
+    _battery = {}
+
+    # valid measurement ranges
+    limits = {
+        'battery': (0, 100),
+        'temperature': (-30, 60),
+        'light': (0, 30000),
+        'soil_moisture': (0, 100),
+        'soil_ec': (0, 5000) }
+    validator = RangeValidator(limits)
+
     def __init__(self, *args, **kwargs):
         self.address = None
         allowed = ['address']
@@ -33,7 +69,7 @@ class MiFlora(BluetoothDevicePlugin, FingerprintMixin):
 
     async def poll(self):
         values = None
-        async with BleakClient(self.address) as client:
+        async with scheduler.connect(self.address, self.priority) as client:
             try:
                 values = await self._read_values(client)
                 if values:
@@ -46,7 +82,7 @@ class MiFlora(BluetoothDevicePlugin, FingerprintMixin):
 
     async def _read_values(self, client):
         results = {}
-        battery, firmware = await self._read_battery_firmware(client)
+        battery, firmware = await self._cached_battery_firmware(client)
         if firmware >= '2.6.6':
             await self._write_mode_change(client)
 
@@ -54,12 +90,39 @@ class MiFlora(BluetoothDevicePlugin, FingerprintMixin):
         if results is not None:
             results['battery'] = battery
 
-        if self._validate(results) is False:
+        if not self.validator(results, self.address):
+            self._battery.pop(self.address, None)
             results = {}
 
         return results
 
 
+    async def _cached_battery_firmware(self, client):
+        """
+        Get battery and firmware values. The device is only read when the
+        cached values are missing, or the battery is due a refresh.
+        args:
+            - connected client
+        returns:
+            tuple (battery:int, firmware:str)
+        """
+
+        now = time.monotonic()
+        firmware = self._firmware.get(self.address)
+        cached = self._battery.get(self.address)
+        if (firmware is None or cached is None or
+            cached[1] >= self.battery_polls or
+            now - cached[2] >= self.battery_seconds):
+            battery, firmware = await self._read_battery_firmware(client)
+            self._firmware[self.address] = firmware
+            self._battery[self.address] = (battery, 1, now)
+            return (battery, firmware)
+
+        battery, polls, when = cached
+        self._battery[self.address] = (battery, polls + 1, when)
+        return (battery, firmware)
+
+
     async def _read_battery_firmware(self, client):
         """
         Read battery and firmware values
@@ -102,83 +165,9 @@ class MiFlora(BluetoothDevicePlugin, FingerprintMixin):
 
 
     def _decode_measurements(self, data):
-        results = {
-            'light': 0,
-            'temperature': 0,
-            'soil_moisture': 0,
-            'soil_ec': 0 }
-
-        def parse_temp(buf):
-            t = int.from_bytes(buf[0:2], byteorder='little')
-            return t/10.0
-
-        def parse_light(buf):
-            l = int.from_bytes(buf[3:7], byteorder='little')
-            return l
-
-        def parse_moisture(buf):
-            m = buf[7]
-            return m
-
-        def parse_ec(buf):
-            c = int.from_bytes(buf[8:10], byteorder='little')
-            return c
-
-        if len(data) == 16:
-            results['temperature'] = parse_temp(data)
-            results['light'] = parse_light(data)
-            results['soil_moisture'] = parse_moisture(data)
-            results['soil_ec'] = parse_ec(data)
-
-        return results
-
-
-    def _validate(self, m):
-        """
-        Validate the measurements. Make sure they are in expected ranges.
-        args:
-            - dict
-        returns:
-            Boolean (True if all measurements are valid)
-        """
-
-        if m is None:
-            return False
-
-        if 'battery' not in m or \
-            m['battery'] is None or \
-            m['battery'] < 0 or \
-            m['battery'] > 100:
-            logger.warning("Invalid battery value %s" % m)
-            return False
-
-        if 'temperature' not in m or \
-            m['temperature'] is None or \
-            m['temperature'] < -30 or \
-            m['temperature'] > 60:
-            logger.warning("Invalid temperature value %s" % m)
-            return False
-
-        if 'light' not in m or \
-            m['light'] is None or \
-            m['light'] < 0 or \
-            m['light'] > 30000:
-            logger.warning("Invalid light value %s" % m)
-            return False
-
-        if 'soil_moisture' not in m or \
-            m['soil_moisture'] is None or \
-            m['soil_moisture'] < 0 or \
-            m['soil_moisture'] > 100:
-            logger.warning("Invalid soil_moisture value %s" % m)
-            return False
-
-        if 'soil_ec' not in m or \
-            m['soil_ec'] is None or \
-            m['soil_ec'] < 0 or \
-            m['soil_ec'] > 5000:
-            logger.warning("Invalid soil_ec value %s" % m)
-            return False
-
-        return True
-
+        temperature, light, moisture, ec = _block.unpack_from(data)
+        return {
+            'temperature': temperature / 10.0,
+            'light': light,
+            'soil_moisture': moisture,
+            'soil_ec': ec }
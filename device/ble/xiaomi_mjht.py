@@ -1,11 +1,20 @@
 import re
-import asyncio
 import logging
-import random
-from bleak import BleakClient
+import os
+import sys
 from potnanny.plugins import BluetoothDevicePlugin
 from potnanny.plugins.mixins import FingerprintMixin
 
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.ble import scheduler
+from _lib.notify import NotificationWaiter
+
 logger = logging.getLogger(__name__)
 
 # version 1.1
@@ -19,6 +28,9 @@ class XiaomiMJHT(BluetoothDevicePlugin, FingerprintMixin):
         'name': re.compile(r'^MJ_HT', re.IGNORECASE)
     }
 
+    # connection priority, lower numbers are served first
+    priority = 10
+
 
     def __init__(self, *args, **kwargs):
         self.address = None
@@ -32,7 +44,7 @@ class XiaomiMJHT(BluetoothDevicePlugin, FingerprintMixin):
 
     async def poll(self):
         values = None
-        async with BleakClient(self.address) as client:
+        async with scheduler.connect(self.address, self.priority) as client:
             try:
                 values = await self._read_measurements(client)
                 await client.disconnect()
@@ -44,23 +56,13 @@ class XiaomiMJHT(BluetoothDevicePlugin, FingerprintMixin):
 
     async def _read_measurements(self, client):
         uuid = '226caa55-6476-4566-7562-66734470666d'
-        bufr = None
-        tries = 10
         values = None
 
-        def callback(sender, data):
-            nonlocal bufr
-            bufr = data
-
-        await client.start_notify(uuid, callback)
-        while tries > 0:
-            if bufr:
-                tries = 0
-                break
-            await asyncio.sleep(0.5)
-            tries -= 1
+        def has_data(data):
+            return len(data) > 0
 
-        await client.stop_notify(uuid)
+        async with NotificationWaiter(client, uuid, has_data, 5) as waiter:
+            bufr = await waiter.wait()
 
         if bufr:
             text = bufr.decode()
@@ -1,11 +1,61 @@
+import time
 import asyncio
 import logging
+import functools
+import os
+import sys
 from potnanny.plugins import PipelinePlugin
 from potnanny.models.control import Control
 
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.metrics import (metrics, SIZE_BUCKETS, batch_size, input_seconds,
+    measurements_in, measurements_out)
+from _lib.measurement import Record, MeasurementBatch, type_code
+from _lib.lanes import owned
+from _lib import generation
+
 
 logger = logging.getLogger(__name__)
 
+_fanout = metrics.histogram('potnanny_control_fanout',
+    "Control inputs dispatched per batch", buckets=SIZE_BUCKETS)
+_control_seconds = metrics.histogram('potnanny_control_input_seconds',
+    "Control input() latency", ['control'])
+_control_failures = metrics.counter('potnanny_control_input_failures_total',
+    "Control input() calls that raised or timed out", ['control'])
+_control_timeouts = metrics.counter('potnanny_control_input_timeouts_total',
+    "Control input() calls that timed out", ['control'])
+
+# python 3.11+. cheaper than wait_for, which runs the call as a new task
+_timeout = getattr(asyncio, 'timeout', None)
+
+
+class _Limit:
+    """
+    Semaphore that remembers its limit. A limit of None does not limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit) if limit else None
+
+
+    async def __aenter__(self):
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        return self
+
+
+    async def __aexit__(self, kind, value, tb):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
 
 class ControlPipeline(PipelinePlugin):
     """
@@ -15,34 +65,277 @@ class ControlPipeline(PipelinePlugin):
     name = "Control Pipeline Plugin"
     description = "Route measurements to device Controls"
 
+    # takes a MeasurementBatch, as well as a list of measurement dicts
+    columnar = True
+
+    # The pipeline creates a new plugin instance for every batch, so the
+    # routing table lives on the class. It maps
+    # (input_device_id, type) -> [Control, ...] and is rebuilt lazily after
+    # a Control is created, updated or deleted. _coded is the same table,
+    # keyed by (input_device_id, type code), for routing a MeasurementBatch.
+    # Changes are counted in _lib.generation, which outlives a reload of
+    # this module, and _generation is the count the table was built at.
+    # max_age is a safety net, for changes that bypass the Control model
+    # hooks (bulk update queries, cascading device deletes, etc).
+    max_age = 300
+    _routes = None
+    _coded = None
+    _routes_built = 0
+    _generation = None
+
+    # Dispatch limits. At most concurrency control inputs run at once, and
+    # each is cancelled after timeout seconds (None for no limit). Controls
+    # switching the same output device run one at a time, in order, so one
+    # unreachable outlet only holds up its own controls.
+    concurrency = 8
+    timeout = 30
+
+    # {control id: number of failed or timed out inputs}
+    failures = {}
+
+    _loop = None
+    _semaphore = None
+    _devices = None
+
     def __init__(self, *args, **kwargs):
         pass
 
 
-    async def input(self, measurements):
-        tasks = []
+    @classmethod
+    def invalidate(cls):
+        """
+        Drop the cached routing table, of this and any reloaded copy of the
+        class. It is rebuilt on next input.
+        """
+
+        generation.bump('controls')
+        cls._routes = None
+
+
+    @classmethod
+    async def routes(cls):
+        """
+        Get the routing table, building it from the database if required
+        args:
+            none
+        returns:
+            dict of {(input_device_id, type): [Control, ...]}
+        """
+
+        current = generation.get('controls')
+        if (cls._routes is not None and cls._generation == current and
+            time.monotonic() - cls._routes_built < cls.max_age):
+            return cls._routes
+
+        routes = {}
         controls = await Control.select()
-        if not controls:
+        for c in controls:
+            try:
+                key = (c.attributes['input_device_id'], c.attributes['type'])
+            except Exception as x:
+                logger.debug("Control %s not routable: %s" % (c.id, x))
+                continue
+
+            routes.setdefault(key, []).append(c)
+
+        cls._coded = {(device_id, type_code(kind)): controls
+            for (device_id, kind), controls in routes.items()}
+        cls._routes = routes
+        cls._routes_built = time.monotonic()
+        cls._generation = current
+        return routes
+
+
+    async def input(self, measurements):
+        if owned(self):
+            # a fan-out lane delivers to this plugin
             return
 
-        for c in controls:
-            for m in measurements:
-
-                # pre-filter, only appropriate measurements go to the control
-                try:
-                    if (c.attributes['input_device_id'] != m['device_id']):
-                        continue
-                    if (c.attributes['type'] != m['type']):
-                        continue
-                    tasks.append(c.input(m))
-                except Exception as x:
-                    logger.debug(x)
-
-        if not len(tasks):
+        with input_seconds.time(plugin='ControlPipeline'):
+            await self._dispatch(measurements)
+
+
+    async def _dispatch(self, measurements):
+        routed = 0
+        batch_size.observe(len(measurements), plugin='ControlPipeline')
+        measurements_in.inc(len(measurements), plugin='ControlPipeline')
+        routes = await self.routes()
+        if not routes:
             return
 
+        if isinstance(measurements, MeasurementBatch):
+            routed_pairs = self._route_batch(measurements, self._coded)
+        else:
+            routed_pairs = self._route(measurements, routes)
+
+        # {output device id: [(control, measurement), ...]}
+        devices = {}
+        for m, controls in routed_pairs:
+            routed += 1
+            for c in controls:
+                devices.setdefault(c.device_id, []).append((c, m))
+
+        calls = sum(len(v) for v in devices.values())
+        measurements_out.inc(routed, plugin='ControlPipeline')
+        _fanout.observe(calls)
+        if not calls:
+            return
+
+        self._limits()
+        await asyncio.gather(*[self._run_device(device_id, inputs)
+            for device_id, inputs in devices.items()])
+
+
+    @classmethod
+    def _limits(cls):
+        """
+        Create the concurrency semaphore and per-device locks, for the
+        running event loop, and after the concurrency setting changed
+        """
+
+        loop = asyncio.get_running_loop()
+        limit = cls.concurrency
+        if (cls._loop is loop and cls._semaphore is not None and
+            cls._semaphore.limit == limit):
+            return
+
+        cls._loop = loop
+        cls._semaphore = _Limit(limit)
+        cls._devices = {}
+
+
+    async def _run_device(self, device_id, inputs):
+        """
+        Run control inputs for one output device, one at a time
+        args:
+            - output device id
+            - list of (control, measurement) tuples
+        """
+
+        lock = self._devices.get(device_id)
+        if lock is None:
+            lock = self._devices[device_id] = asyncio.Lock()
+
+        async with lock:
+            for c, m in inputs:
+                await self._run(c, m)
+
+
+    async def _run(self, control, measurement):
+        """
+        Run one control input, under the concurrency limit and timeout.
+        Failures are logged and counted against the control, and never
+        raised.
+        """
+
+        # a TimeoutError raised by control.input() itself is a failure,
+        # not a timeout. only an expired deadline counts as a timeout.
+        expired = False
         try:
-            await asyncio.gather(*tasks)
+            async with self._semaphore:
+                with _control_seconds.time(control=control.id):
+                    if not self.timeout:
+                        await control.input(measurement)
+                    elif _timeout is not None:
+                        deadline = _timeout(self.timeout)
+                        try:
+                            async with deadline:
+                                await control.input(measurement)
+                        finally:
+                            expired = deadline.expired()
+                    else:
+                        loop = asyncio.get_running_loop()
+                        started = loop.time()
+                        try:
+                            await asyncio.wait_for(control.input(measurement),
+                                self.timeout)
+                        except asyncio.TimeoutError:
+                            expired = loop.time() - started >= self.timeout
+                            raise
+            return
         except Exception as x:
-            logger.warning(x)
+            if expired:
+                _control_timeouts.inc(control=control.id)
+                logger.warning("Control %s (%s) input timed out after %ss" % (
+                    control.id, control.name, self.timeout))
+            else:
+                logger.warning("Control %s (%s) input failed: %s" % (
+                    control.id, control.name, x))
+
+        failures = type(self).failures
+        failures[control.id] = failures.get(control.id, 0) + 1
+        _control_failures.inc(control=control.id)
+
+
+    @staticmethod
+    def _route(measurements, routes):
+        """
+        Find the controls of each measurement
+        args:
+            - list of measurement dicts (or Records)
+            - routing table
+        returns:
+            generator of (measurement dict, [Control, ...]) tuples, for the
+            measurements that have controls
+        """
+
+        for m in measurements:
+            try:
+                if type(m) is Record:
+                    controls = routes.get((m.device_id, m.type))
+                    if controls:
+                        # controls and actions take measurement dicts
+                        m = m.as_dict()
+                else:
+                    controls = routes.get((m['device_id'], m['type']))
+            except Exception as x:
+                logger.debug(x)
+                continue
+
+            if controls:
+                yield m, controls
+
+
+    @staticmethod
+    def _route_batch(batch, coded):
+        """
+        Find the controls of each measurement in a batch. Only measurements
+        that have controls are made into dicts.
+        args:
+            - MeasurementBatch
+            - routing table, keyed by type code
+        returns:
+            generator of (measurement dict, [Control, ...]) tuples
+        """
+
+        get = coded.get
+        for i, key in enumerate(zip(batch.device_ids, batch.types)):
+            controls = get(key)
+            if controls:
+                yield batch.as_dict(i), controls
+
+
+def _invalidates_routes(method):
+    """
+    Wrap a Control model coroutine so that it drops the routing table.
+    The wrapper is installed once, and outlives reloads of this module, so
+    it bumps the shared counter instead of calling a ControlPipeline class.
+    """
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            generation.bump('controls')
+
+    wrapper._invalidates_routes = True
+    return wrapper
+
 
+# Control.create() goes through save(), so these two cover create,
+# update and delete of Control objects.
+for _name in ('save', 'delete_instance'):
+    _method = getattr(Control, _name)
+    if not getattr(_method, '_invalidates_routes', False):
+        setattr(Control, _name, _invalidates_routes(_method))
@@ -1,12 +1,42 @@
+import time
 import asyncio
 import logging
+import os
+import sys
 from potnanny.database import db, lock
 from potnanny.plugins import PipelinePlugin
 from potnanny.models.measurement import Measurement, MeasurementSchema
 
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.metrics import (metrics, batch_size, input_seconds,
+    measurements_in, measurements_out, measurements_rejected)
+from _lib.measurement import FIELDS, MeasurementBatch, validate
+from _lib.lanes import owned
+
 
 logger = logging.getLogger(__name__)
 
+_rows_written = metrics.counter('potnanny_db_rows_written_total',
+    "Measurement rows written to the database")
+_rows_failed = metrics.counter('potnanny_db_rows_failed_total',
+    "Measurement rows that failed to write (once per write-behind attempt)")
+_write_retries = metrics.counter('potnanny_db_write_retries_total',
+    "Write-behind writer restarts after a failed write or connection")
+_rows_dropped = metrics.counter('potnanny_db_rows_dropped_total',
+    "Measurement rows dropped from a full write-behind queue")
+_rows_filtered = metrics.counter('potnanny_db_rows_filtered_total',
+    "Measurement rows not saved, inside the deadband of the last saved value")
+_lock_wait = metrics.histogram('potnanny_db_lock_wait_seconds',
+    "Time spent waiting for the database lock")
+_transaction_seconds = metrics.histogram('potnanny_db_transaction_seconds',
+    "Database write transaction duration")
+
 
 class DBPipeline(PipelinePlugin):
     """
@@ -16,26 +46,409 @@ class DBPipeline(PipelinePlugin):
     name = "Database Insert Plugin"
     description = "Insert measurements to Potnanny database"
 
+    # takes a MeasurementBatch, as well as a list of measurement dicts
+    columnar = True
+
+    # Insert each batch with multi-row INSERT statements, instead of one
+    # statement per measurement. chunk_size keeps each statement under the
+    # SQLite bound-variable limit.
+    bulk = True
+    chunk_size = 200
+
+    # Validate lists of measurement dicts with potnanny's marshmallow
+    # MeasurementSchema, before the built-in validator. Much slower, and one
+    # invalid measurement fails the whole batch. The built-in validator
+    # leaves out invalid measurements only. A MeasurementBatch was validated
+    # when it was made.
+    marshmallow = False
+
+    # Write-behind mode. input() only queues the clean measurements, and a
+    # single writer task flushes them when flush_rows are waiting or
+    # flush_ms has passed since the first one arrived, whichever is first.
+    # When the queue is full, overflow decides what happens:
+    #   'block'       = caller waits for room in the queue (backpressure)
+    #   'drop_newest' = incoming measurements are discarded
+    #   'drop_oldest' = oldest queued measurements are discarded
+    # A batch that fails to write stays with the writer, and is retried
+    # after retry_seconds, doubling up to retry_max, until it is written.
+    # Meanwhile the queue fills, and overflow applies. A dedicated writer
+    # also reopens its connection before each retry.
+    # Potnanny has no shutdown hook for plugins. Whatever is still queued
+    # when the process exits is lost, unless the host application awaits
+    # DBPipeline.shutdown() (or flush()) before it stops the event loop.
+    write_behind = False
+    flush_rows = 500
+    flush_ms = 1000
+    queue_size = 5000
+    overflow = 'block'
+    retry_seconds = 1
+    retry_max = 60
+    dropped = 0
+
+    # Dedicated writer mode (implies write-behind). The writer task holds
+    # its own database connection for as long as it runs, and writes
+    # without taking the global potnanny.database.lock. Pipeline inserts
+    # then never stall other users of the lock. The database must accept a
+    # writer alongside other connections (SQLite in WAL mode, or a server
+    # database).
+    dedicated_writer = False
+
+    # Deadband filter. A measurement is only saved when its value moved
+    # more than deadband (absolute), or more than deadband_relative (a
+    # fraction of the last saved value), away from the last saved value of
+    # the same device and type, or when heartbeat seconds have passed since
+    # that was saved. A deadband of 0 saves changes only. deadbands holds
+    # per-type overrides, like {'soil_moisture': (1, None)}. With neither
+    # set (the default), every measurement is saved.
+    deadband = None
+    deadband_relative = None
+    deadbands = {}
+    heartbeat = 900
+    filtered = 0
+
+    # {(device_id, type): (last saved value, monotonic time saved)}
+    _last = {}
+
+    _queue = None
+    _writer = None
+    _wakeup = None
+    _flushes = 0
+
+    # rows taken from the queue by the writer, and not yet written
+    _inflight = None
+    _backoff = None
+
 
     async def input(self, measurements):
         """
         Accept measurments input, and insert into db
 
         args:
-            - list of measurement dicts
+            - list of measurement dicts (or Records), or a MeasurementBatch
+        returns:
+            none
+        """
+
+        if owned(self):
+            # a fan-out lane delivers to this plugin
+            return
+
+        with input_seconds.time(plugin='DBPipeline'):
+            batch_size.observe(len(measurements), plugin='DBPipeline')
+            measurements_in.inc(len(measurements), plugin='DBPipeline')
+            if (self.marshmallow and
+                not isinstance(measurements, MeasurementBatch)):
+                schema = MeasurementSchema(many=True)
+                clean = validate(schema.load(measurements), sanitize=False)
+            else:
+                clean = validate(measurements)
+
+            rejected = len(measurements) - len(clean)
+            if rejected:
+                measurements_rejected.inc(rejected, plugin='DBPipeline')
+                logger.warning("Rejected %d invalid measurements" % rejected)
+
+            if (self.deadband is not None or
+                self.deadband_relative is not None or self.deadbands):
+                clean = self._filter(clean)
+            measurements_out.inc(len(clean), plugin='DBPipeline')
+            if not clean:
+                return
+
+            if self.write_behind or self.dedicated_writer:
+                await self._enqueue(clean)
+            else:
+                await self._write(clean)
+
+
+    @classmethod
+    def _filter(cls, rows):
+        """
+        Drop measurements inside the deadband of the last saved value
+        args:
+            - list of measurement Records
+        returns:
+            list of measurement Records to save
+        """
+
+        now = time.monotonic()
+        last = cls._last
+        default = (cls.deadband, cls.deadband_relative)
+        keep = []
+        for m in rows:
+            key = (m.device_id, m.type)
+            value = m.value
+            prior = last.get(key)
+            if prior is not None and now - prior[1] < cls.heartbeat:
+                absolute, relative = cls.deadbands.get(m.type, default)
+                change = abs(value - prior[0])
+                if ((absolute is not None or relative is not None) and
+                    (absolute is None or change <= absolute) and
+                    (relative is None or change <= abs(prior[0]) * relative)):
+                    continue
+
+            last[key] = (value, now)
+            keep.append(m)
+
+        filtered = len(rows) - len(keep)
+        if filtered:
+            cls.filtered += filtered
+            _rows_filtered.inc(filtered)
+
+        return keep
+
+
+    @classmethod
+    async def flush(cls):
+        """
+        Write everything in the write-behind queue to the database now,
+        and wait for it to complete.
+        """
+
+        if cls._queue is None:
+            return
+
+        cls._start()
+        cls._flushes += 1
+        cls._wakeup.set()
+        try:
+            await cls._queue.join()
+        finally:
+            cls._flushes -= 1
+
+
+    @classmethod
+    async def shutdown(cls, timeout=None):
+        """
+        Flush the write-behind queue, and stop the writer task
+        args:
+            - seconds to wait for the flush (None waits until it is done)
+        """
+
+        try:
+            await asyncio.wait_for(cls.flush(), timeout)
+        except asyncio.TimeoutError:
+            lost = cls._queue.qsize() + len(cls._inflight or ())
+            logger.warning("Write-behind shutdown timed out, %d measurements "
+                "not written" % lost)
+
+        if cls._writer is not None:
+            cls._writer.cancel()
+            try:
+                await cls._writer
+            except asyncio.CancelledError:
+                pass
+
+        cls._writer = None
+        cls._queue = None
+        cls._inflight = None
+
+
+    @classmethod
+    def _start(cls):
+        """
+        Create the queue and writer task, if not already running. A writer
+        that died is restarted on the same queue, so nothing queued is lost.
+        """
+
+        writer = cls._writer
+        if writer is not None:
+            if not writer.done():
+                return
+
+            if not writer.cancelled() and writer.exception() is not None:
+                logger.warning("Write-behind writer stopped, restarting: %s" % (
+                    writer.exception()))
+
+        if cls._queue is None:
+            cls._queue = asyncio.Queue(maxsize=cls.queue_size)
+            cls._wakeup = asyncio.Event()
+        cls._writer = asyncio.create_task(cls._run_writer())
+
+
+    async def _enqueue(self, rows):
+        """
+        Put measurement Records on the write-behind queue
+        args:
+            - list of measurement Records
+        returns:
+            none
+        """
+
+        self._start()
+        queue = self._queue
+        dropped = 0
+        for m in rows:
+            if queue.full():
+                if self.overflow == 'drop_newest':
+                    dropped += 1
+                    continue
+                elif self.overflow == 'drop_oldest':
+                    queue.get_nowait()
+                    queue.task_done()
+                    dropped += 1
+
+            await queue.put(m)
+            self._wakeup.set()
+
+        if dropped:
+            type(self).dropped += dropped
+            _rows_dropped.inc(dropped)
+            logger.warning("Write queue full, dropped %d measurements" % dropped)
+
+
+    @classmethod
+    async def _run_writer(cls):
+        """
+        Writer task. A dedicated writer holds one connection, until a write
+        or the connection fails. After a failure, the writer backs off and
+        starts over (with a new connection), retrying the failed batch.
+        """
+
+        cls._backoff = cls.retry_seconds
+        while True:
+            try:
+                if cls.dedicated_writer:
+                    async with db.connection():
+                        await cls._write_batches(locked=False)
+                else:
+                    await cls._write_batches(locked=True)
+            except Exception as x:
+                logger.warning("Write-behind writer failed with %d measurements "
+                    "in flight, retrying in %ss: %s" % (
+                    len(cls._inflight or ()), cls._backoff, x))
+                _write_retries.inc()
+                await asyncio.sleep(cls._backoff)
+                cls._backoff = min(cls._backoff * 2, cls.retry_max)
+
+
+    @classmethod
+    async def _write_batches(cls, locked):
+        """
+        Collect queued rows into batches and write them. Rows stay in
+        _inflight until they are written, so after a failed write (which
+        is raised) or a restarted writer, the batch is written first.
+        args:
+            - take the global lock for each write?
+        """
+
+        loop = asyncio.get_running_loop()
+        queue = cls._queue
+        writer = cls()
+        while True:
+            if cls._inflight:
+                await writer._write(cls._inflight, locked)
+                cls._done(queue)
+
+            rows = cls._inflight = [await queue.get()]
+            deadline = loop.time() + (cls.flush_ms / 1000.0)
+            while len(rows) < cls.flush_rows:
+                while not queue.empty() and len(rows) < cls.flush_rows:
+                    rows.append(queue.get_nowait())
+
+                timeout = deadline - loop.time()
+                if (len(rows) >= cls.flush_rows or cls._flushes or
+                    timeout <= 0):
+                    break
+
+                cls._wakeup.clear()
+                try:
+                    await asyncio.wait_for(cls._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            await writer._write(rows, locked)
+            cls._done(queue)
+
+
+    @classmethod
+    def _done(cls, queue):
+        """
+        Mark the in-flight rows done on the queue
+        """
+
+        for i in range(len(cls._inflight)):
+            queue.task_done()
+        cls._inflight = None
+        cls._backoff = cls.retry_seconds
+
+
+    async def _write(self, rows, locked=True):
+        """
+        Insert clean rows in a single transaction
+        args:
+            - list of measurement Records
+            - hold the global database lock while writing?
         returns:
             none
         """
 
-        schema = MeasurementSchema(many=True)
-        clean = schema.load(measurements)
+        if locked:
+            with _lock_wait.time():
+                await lock.acquire()
+
+        try:
+            with _transaction_seconds.time():
+                async with db.transaction():
+                    if self.bulk:
+                        failed = await self._insert_bulk(rows)
+                    else:
+                        failed = await self._insert_rows(rows)
+        except BaseException:
+            _rows_failed.inc(len(rows))
+            raise
+        finally:
+            if locked:
+                lock.release()
+
+        _rows_written.inc(len(rows) - failed)
+        _rows_failed.inc(failed)
+
 
-        async with lock:
-            async with db.transaction():
-                for m in clean:
-                    try:
-                        obj = await Measurement.create(**m)
-                    except Exception as x:
-                        logger.debug(x)
+    async def _insert_bulk(self, rows):
+        """
+        Insert rows in chunks, one statement per chunk. If a chunk fails, it
+        is rolled back and retried row by row, so the failure can be
+        reported against the offending row(s) only.
+        args:
+            - list of measurement Records
+        returns:
+            number of rows that failed
+        """
+
+        failed = 0
+        for i in range(0, len(rows), self.chunk_size):
+            chunk = rows[i:(i + self.chunk_size)]
+            try:
+                async with db.transaction():
+                    await Measurement.insert_many(chunk, fields=FIELDS)
+            except Exception as x:
+                logger.debug("Bulk insert failed, retrying by row: %s" % x)
+                failed += await self._insert_rows(chunk, savepoints=True)
+
+        return failed
+
+
+    async def _insert_rows(self, rows, savepoints=False):
+        """
+        Insert rows one at a time
+        args:
+            - list of measurement Records
+            - wrap each insert in a savepoint?
+        returns:
+            number of rows that failed
+        """
 
+        failed = 0
+        for m in rows:
+            try:
+                if savepoints:
+                    async with db.transaction():
+                        obj = await Measurement.create(**m._asdict())
+                else:
+                    obj = await Measurement.create(**m._asdict())
+            except Exception as x:
+                failed += 1
+                logger.debug("Insert failed for %s: %s" % (m, x))
 
+        return failed
@@ -0,0 +1,323 @@
+import copy
+import time
+import asyncio
+import logging
+import collections
+import os
+import sys
+from potnanny.plugins import PipelinePlugin
+
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.metrics import metrics
+from _lib.measurement import MeasurementBatch
+from _lib.lanes import fanout, deliver
+
+
+logger = logging.getLogger(__name__)
+
+_depth = metrics.gauge('potnanny_fanout_queue_depth',
+    "Batches waiting in a fan-out lane", ['lane'])
+_lag = metrics.gauge('potnanny_fanout_lag_seconds',
+    "Time the last batch started by a fan-out lane had waited", ['lane'])
+_wait = metrics.histogram('potnanny_fanout_wait_seconds',
+    "Time batches wait in a fan-out lane", ['lane'])
+_dropped = metrics.counter('potnanny_fanout_dropped_total',
+    "Batches dropped from a full fan-out lane", ['lane'])
+_failures = metrics.counter('potnanny_fanout_failures_total',
+    "Pipeline plugin inputs that raised, in a fan-out lane", ['lane', 'plugin'])
+
+
+class _Lane:
+    """
+    One fan-out lane. A bounded queue of batches, and the consumer task
+    delivering them to the lane plugins.
+    """
+
+    def __init__(self, name, plugins, priority=0, size=100,
+        overflow='block', *args, **kwargs):
+        self.name = name
+        self.plugin_names = list(plugins)
+        self.plugins = []
+        self.priority = priority
+        self.size = size
+        self.overflow = overflow
+
+        self.queue = None
+        self.consumer = None
+        self.idle = None
+
+        # enqueue times of the queued batches, oldest first
+        self.times = collections.deque()
+        self.dropped = 0
+        self.processed = 0
+        self.lag = 0.0
+
+
+    def status(self):
+        oldest = 0.0
+        if self.times:
+            oldest = time.monotonic() - self.times[0]
+
+        return {
+            'plugins': [p.__name__ for p in self.plugins],
+            'priority': self.priority,
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            'oldest': oldest,
+            'lag': self.lag,
+            'processed': self.processed,
+            'dropped': self.dropped }
+
+
+class FanoutPipeline(PipelinePlugin):
+    """
+    Class to deliver measurements to other pipeline plugins, through a
+    separate bounded queue and consumer task for each lane.
+
+    The pipeline awaits every plugin's input() together, so a slow plugin
+    (database inserts on a busy SQLite file) holds up the collection cycle,
+    and competes with the control plugin for the event loop. Behind a
+    fan-out lane, a plugin only delays its own lane. Lanes are served in
+    priority order: a lane only starts a batch when no higher priority lane
+    has batches waiting.
+    """
+
+    name = "Fan-out Pipeline Plugin"
+    description = "Deliver measurements to pipeline plugins through queues"
+
+    # Each lane is a dict of
+    #   name     = lane name, for metrics and logs
+    #   plugins  = class names of the pipeline plugins the lane delivers to
+    #   priority = lower numbers are served first (default 0)
+    #   size     = batches the lane queue holds (default 100)
+    #   overflow = when the queue is full (default 'block')
+    #       'block'       = input waits for room in the queue (backpressure)
+    #       'drop_newest' = the incoming batch is discarded
+    #       'drop_oldest' = the oldest queued batch is discarded
+    # Plugins in a lane ignore the batches the pipeline hands them directly,
+    # so they only receive measurements through the lane. That takes a check
+    # at the top of their input() (see _lib/lanes.py), which the pipeline
+    # plugins in this directory have. With no lanes (the default), this
+    # plugin does nothing. For example:
+    #   FanoutPipeline.lanes = [
+    #       {'name': 'control', 'plugins': ['ControlPipeline']},
+    #       {'name': 'storage', 'plugins': ['DBPipeline', 'RollupPipeline'],
+    #        'priority': 1, 'size': 1000}]
+    lanes = []
+
+    _lanes = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+    async def input(self, measurements):
+        """
+        Accept measurements input, and queue them on every lane
+
+        args:
+            - list of measurement dicts
+        returns:
+            none
+        """
+
+        cls = type(self)
+        if not cls.lanes or fanout() is not cls:
+            # no lanes, or this class is from before potnanny loaded the
+            # plugins again. the newest class runs the lanes.
+            return
+
+        if cls._lanes is None:
+            cls._setup()
+        cls._start()
+
+        batch = None
+        if any(getattr(p, 'columnar', False)
+            for lane in cls._lanes for p in lane.plugins):
+            # one columnar batch, shared by all plugins that take them
+            batch = MeasurementBatch.from_dicts(measurements)
+
+        now = time.monotonic()
+        for lane in cls._lanes:
+            if lane.plugins:
+                await cls._put(lane, (now, measurements, batch))
+
+
+    @classmethod
+    def _setup(cls):
+        """
+        Build the lanes. Plugins are looked up by class name, and a plugin
+        registered more than once (potnanny loaded the plugins again) is
+        delivered to as its newest class.
+        """
+
+        registered = {}
+        for p in PipelinePlugin.plugins:
+            registered[p.__name__] = p
+
+        lanes = []
+        for config in sorted(cls.lanes, key=lambda c: c.get('priority', 0)):
+            lane = _Lane(**config)
+            for name in lane.plugin_names:
+                plugin = registered.get(name)
+                if plugin is None or issubclass(plugin, FanoutPipeline):
+                    logger.warning("Fan-out lane %s: no pipeline plugin %s" % (
+                        lane.name, name))
+                    continue
+
+                lane.plugins.append(plugin)
+
+            lanes.append(lane)
+
+        cls._lanes = lanes
+
+
+    @classmethod
+    def _start(cls):
+        """
+        Create lane queues and consumer tasks, if not already running
+        """
+
+        for i, lane in enumerate(cls._lanes):
+            if lane.consumer is not None and not lane.consumer.done():
+                continue
+
+            lane.queue = asyncio.Queue(maxsize=lane.size)
+            lane.times.clear()
+            lane.idle = asyncio.Event()
+            lane.idle.set()
+            lane.consumer = asyncio.create_task(
+                cls._consume(lane, cls._lanes[:i]))
+
+
+    @classmethod
+    async def _put(cls, lane, item):
+        queue = lane.queue
+        if queue.full():
+            if lane.overflow == 'drop_newest':
+                cls._drop(lane)
+                return
+            elif lane.overflow == 'drop_oldest':
+                queue.get_nowait()
+                queue.task_done()
+                lane.times.popleft()
+                cls._drop(lane)
+
+        lane.idle.clear()
+        lane.times.append(item[0])
+        await queue.put(item)
+        _depth.set(queue.qsize(), lane=lane.name)
+
+
+    @staticmethod
+    def _drop(lane):
+        lane.dropped += 1
+        _dropped.inc(lane=lane.name)
+        logger.warning("Fan-out lane %s full, dropped a batch" % lane.name)
+
+
+    @classmethod
+    async def _consume(cls, lane, higher):
+        """
+        Consumer task of one lane
+        args:
+            - the lane
+            - list of higher priority lanes
+        """
+
+        queue = lane.queue
+        while True:
+            item = await queue.get()
+            lane.times.popleft()
+            try:
+                # let higher priority lanes take their batches first
+                for h in higher:
+                    while not h.queue.empty():
+                        await h.idle.wait()
+
+                if queue.empty():
+                    lane.idle.set()
+                _depth.set(queue.qsize(), lane=lane.name)
+
+                when, measurements, batch = item
+                lane.lag = time.monotonic() - when
+                _lag.set(lane.lag, lane=lane.name)
+                _wait.observe(lane.lag, lane=lane.name)
+                await cls._deliver(lane, measurements, batch)
+                lane.processed += 1
+            finally:
+                queue.task_done()
+
+
+    @staticmethod
+    async def _deliver(lane, measurements, batch):
+        """
+        Hand one batch to the lane plugins, one after the other
+        """
+
+        for p in lane.plugins:
+            if batch is not None and getattr(p, 'columnar', False):
+                data = batch
+            else:
+                data = copy.deepcopy(measurements)
+
+            try:
+                await deliver(p).input(data)
+            except Exception as x:
+                _failures.inc(lane=lane.name, plugin=p.__name__)
+                logger.warning("Fan-out lane %s, %s input failed: %s" % (
+                    lane.name, p.__name__, x))
+
+
+    @classmethod
+    def status(cls):
+        """
+        Get the state of each lane
+        returns:
+            dict of {lane name: {depth, oldest, lag, processed, ...}}
+        """
+
+        if cls._lanes is None:
+            return {}
+
+        return {lane.name: lane.status() for lane in cls._lanes}
+
+
+    @classmethod
+    async def flush(cls):
+        """
+        Wait for every lane to deliver its queued batches
+        """
+
+        if cls._lanes is None:
+            return
+
+        for lane in cls._lanes:
+            if lane.queue is not None:
+                await lane.queue.join()
+
+
+    @classmethod
+    async def shutdown(cls):
+        """
+        Deliver queued batches, and stop the consumer tasks
+        """
+
+        if cls._lanes is None:
+            return
+
+        await cls.flush()
+        for lane in cls._lanes:
+            if lane.consumer is not None:
+                lane.consumer.cancel()
+                try:
+                    await lane.consumer
+                except asyncio.CancelledError:
+                    pass
+
+        cls._lanes = None
@@ -0,0 +1,373 @@
+import asyncio
+import logging
+import datetime
+import os
+import sys
+from peewee import Case, EXCLUDED
+from peewee_aio import fields
+from potnanny.database import db, lock, BaseModel
+from potnanny.plugins import PipelinePlugin
+from potnanny.models.device import Device
+
+# the potnanny plugin loader does not set __file__, or put the plugin
+# directory on the python path. add it, so the _lib helpers import.
+_root = os.path.abspath(os.path.join(
+    sys._getframe().f_code.co_filename, '..', '..'))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from _lib.metrics import measurements_in, measurements_out
+from _lib.lanes import owned
+
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class MeasurementRollup(BaseModel):
+    """
+    Aggregate of one device measurement type, over one time bucket
+    """
+
+    id = fields.AutoField()
+    device = fields.ForeignKeyField(Device,
+        on_delete='CASCADE',
+        backref='rollups' )
+    type = fields.CharField(24)
+    interval = fields.IntegerField()
+    start = fields.DateTimeField()
+    count = fields.IntegerField()
+    min = fields.FloatField()
+    max = fields.FloatField()
+    mean = fields.FloatField()
+    last = fields.FloatField()
+
+    class Meta:
+        table_name = 'measurement_rollup'
+        indexes = (
+            (('device', 'type', 'interval', 'start'), True),
+        )
+
+
+    def as_dict(self):
+        return {
+            'device_id': self.device_id,
+            'type': self.type,
+            'interval': self.interval,
+            'start': self.start.isoformat() + "Z",
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'last': self.last,
+        }
+
+
+# merge a rollup row written again into the stored one. SET expressions see
+# the stored row as it was, before any of them apply.
+_KEY = [MeasurementRollup.device, MeasurementRollup.type,
+    MeasurementRollup.interval, MeasurementRollup.start]
+_MERGE = {
+    MeasurementRollup.count: MeasurementRollup.count + EXCLUDED.count,
+    MeasurementRollup.min: Case(None, [
+        (EXCLUDED.min < MeasurementRollup.min, EXCLUDED.min)],
+        MeasurementRollup.min),
+    MeasurementRollup.max: Case(None, [
+        (EXCLUDED.max > MeasurementRollup.max, EXCLUDED.max)],
+        MeasurementRollup.max),
+    MeasurementRollup.mean: (
+        MeasurementRollup.mean * MeasurementRollup.count +
+        EXCLUDED.mean * EXCLUDED.count) / (
+        MeasurementRollup.count + EXCLUDED.count),
+    MeasurementRollup.last: EXCLUDED.last }
+
+
+class RollupPipeline(PipelinePlugin):
+    """
+    Class to keep running per-device, per-type aggregates of measurements,
+    and save them to the database as time buckets close.
+
+    Each measurement updates its open buckets in place (count, min, max,
+    sum and last), so the cost per measurement does not depend on how many
+    readings a bucket holds. A bucket closes when a measurement for a later
+    bucket arrives, or when the bucket end plus grace seconds has passed
+    (checked by a timer task, so buckets close without new input). Closed
+    buckets are written in bulk.
+
+    With long-range charts reading the rollups, raw measurements only need
+    to be kept for a short time.
+    """
+
+    name = "Measurement Rollup Plugin"
+    description = "Save per-minute min/max/mean measurement aggregates"
+
+    # off by default. every measurement costs a bucket update per interval,
+    # and every bucket a row. set True to keep rollups.
+    enabled = False
+
+    # bucket sizes, in seconds
+    intervals = [60]
+
+    # seconds past a bucket end, to wait for late measurements
+    grace = 10
+
+    # closed buckets are written when this many are waiting, or when the
+    # oldest has waited flush_seconds
+    flush_rows = 200
+    flush_seconds = 60
+
+    # closed buckets kept for retry while the database is failing
+    max_pending = 20000
+
+    # seconds between timer checks for expired buckets
+    sweep_seconds = 10
+
+    # measurements older than their open bucket, so not counted
+    late = 0
+
+    # {(device_id, type, interval): [start, count, min, max, total, last]}
+    # a count of 0 marks a closed bucket
+    _buckets = {}
+    _closed = []
+    _closed_since = None
+    _swept = 0
+    _table_ready = False
+    _timer = None
+
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+    async def input(self, measurements):
+        """
+        Accept measurements input, and update the aggregates
+
+        args:
+            - list of measurement dicts
+        returns:
+            none
+        """
+
+        cls = type(self)
+        if not cls.enabled or owned(self):
+            return
+
+        cls._start()
+        measurements_in.inc(len(measurements), plugin='RollupPipeline')
+        for m in measurements:
+            try:
+                key = (int(m['device_id']), m['type'])
+                value = float(m['value'])
+                when = self._timestamp(m.get('created'))
+            except Exception as x:
+                logger.debug("Measurement not aggregated %s: %s" % (m, x))
+                continue
+
+            for interval in cls.intervals:
+                cls._update(key + (interval,), when - (when % interval), value)
+
+        await cls._sweep()
+
+
+    @classmethod
+    async def _sweep(cls):
+        """
+        Close expired buckets, and write the closed ones if enough are
+        waiting, or the oldest has waited long enough
+        """
+
+        now = cls._timestamp(None)
+        if now != cls._swept:
+            # at most once a second, whatever the measurement rate
+            cls._swept = now
+            cls._close_expired(now)
+        if cls._closed and (len(cls._closed) >= cls.flush_rows or
+            now - cls._closed_since >= cls.flush_seconds):
+            await cls.flush()
+
+
+    @classmethod
+    def _start(cls):
+        """
+        Create the timer task, if not already running
+        """
+
+        if cls._timer is None or cls._timer.done():
+            cls._timer = asyncio.create_task(cls._run_timer())
+
+
+    @classmethod
+    async def _run_timer(cls):
+        """
+        Timer task. Closes and writes buckets when no measurements arrive
+        """
+
+        while True:
+            await asyncio.sleep(cls.sweep_seconds)
+            try:
+                await cls._sweep()
+            except Exception as x:
+                logger.warning("Rollup sweep failed: %s" % x)
+
+
+    @classmethod
+    async def shutdown(cls):
+        """
+        Stop the timer task, and write all buckets, open or closed
+        """
+
+        if cls._timer is not None:
+            cls._timer.cancel()
+            try:
+                await cls._timer
+            except asyncio.CancelledError:
+                pass
+            cls._timer = None
+
+        await cls.flush(close_open=True)
+
+
+    @classmethod
+    def _update(cls, key, start, value):
+        """
+        Add a value to the open bucket for a key
+        """
+
+        bucket = cls._buckets.get(key)
+        if bucket is not None:
+            if start == bucket[0] and bucket[1]:
+                bucket[1] += 1
+                if value < bucket[2]:
+                    bucket[2] = value
+                if value > bucket[3]:
+                    bucket[3] = value
+                bucket[4] += value
+                bucket[5] = value
+                return
+
+            if start <= bucket[0]:
+                # older than the open bucket, or its bucket already closed
+                cls.late += 1
+                return
+
+            if bucket[1]:
+                cls._close(key, bucket)
+
+        cls._buckets[key] = [start, 1, value, value, value, value]
+
+
+    @classmethod
+    def _close(cls, key, bucket):
+        """
+        Queue a bucket for writing, and mark it closed (count 0). The
+        closed bucket is kept, to recognize late measurements for it.
+        """
+
+        device_id, kind, interval = key
+        start, count, low, high, total, last = bucket
+        if not cls._closed:
+            cls._closed_since = cls._timestamp(None)
+
+        cls._closed.append({
+            'device_id': device_id,
+            'type': kind,
+            'interval': interval,
+            'start': _EPOCH + datetime.timedelta(seconds=start),
+            'count': count,
+            'min': low,
+            'max': high,
+            'mean': total / count,
+            'last': last })
+        bucket[1] = 0
+
+
+    @classmethod
+    def _close_expired(cls, now):
+        """
+        Close open buckets that ended more than grace seconds ago
+        """
+
+        for key, bucket in cls._buckets.items():
+            if bucket[1] and bucket[0] + key[2] + cls.grace <= now:
+                cls._close(key, bucket)
+
+
+    @staticmethod
+    def _timestamp(created):
+        """
+        Get UTC epoch seconds of a measurement time (now, if None)
+        """
+
+        if created is None:
+            created = datetime.datetime.utcnow()
+        elif not isinstance(created, datetime.datetime):
+            created = datetime.datetime.fromisoformat(str(created).rstrip('Z'))
+
+        if created.tzinfo is not None:
+            created = created.astimezone(datetime.timezone.utc).replace(
+                tzinfo=None)
+
+        return int((created - _EPOCH).total_seconds())
+
+
+    @classmethod
+    async def flush(cls, close_open=False):
+        """
+        Write closed buckets to the database
+        args:
+            - close and write the open buckets too?
+        returns:
+            none
+        """
+
+        if close_open:
+            for key, bucket in cls._buckets.items():
+                if bucket[1]:
+                    cls._close(key, bucket)
+
+        if not cls._closed:
+            return
+
+        rows = cls._closed
+        cls._closed = []
+        cls._closed_since = None
+        try:
+            await cls._write(rows)
+        except Exception as x:
+            logger.warning("Rollup write failed, will retry: %s" % x)
+            rows += cls._closed
+            if len(rows) > cls.max_pending:
+                logger.warning("Dropping %d rollup rows" % (
+                    len(rows) - cls.max_pending))
+                rows = rows[-cls.max_pending:]
+            cls._closed = rows
+            cls._closed_since = cls._timestamp(None)
+            return
+
+        measurements_out.inc(len(rows), plugin='RollupPipeline')
+
+
+    @classmethod
+    async def _write(cls, rows):
+        """
+        Insert rollup rows in bulk. A bucket written again (after a restart,
+        for example) is merged into the earlier row: counts add up, the mean
+        is weighted by count, min and max cover both, and last is the new
+        row's.
+        """
+
+        if not cls._table_ready:
+            db.register(MeasurementRollup)
+            await MeasurementRollup.create_table(safe=True)
+            cls._table_ready = True
+
+        async with lock:
+            async with db.transaction():
+                # 10 columns per row, under the SQLite variable limit
+                for i in range(0, len(rows), 50):
+                    await MeasurementRollup.insert_many(
+                        rows[i:(i + 50)]).on_conflict(
+                        conflict_target=_KEY, update=_MERGE)
+